@@ -50,7 +50,30 @@ test_notebooks = [
 "./tests/AggsTestInnerGroupByLeft",
 "./tests/AggsTestInnerGroupByLeftLeftGroupBy",
 "./tests/AggsTestRightGroupByInnerGroupBy",
-"./tests/AggsTestRightGroupByInnerGroupByMax"
+"./tests/AggsTestRightGroupByInnerGroupByMax",
+"./tests/AggsTestGroupByPruned",
+"./tests/JoinTestLeftInnerCoalesced",
+"./tests/AggsTestGroupByKeyValue",
+"./tests/AggsTestGroupByRetractableMax",
+"./tests/AggsTestGroupByCountDistinct",
+"./tests/AggsTestGroupByPercentile",
+"./tests/AggsTestGroupByPercentileLeft",
+"./tests/AggsTestGroupByAvgStddev",
+"./tests/AggsTestGroupByStddevOffset",
+"./tests/AggsTestLeftInnerGroupByPreAggregated",
+"./tests/AggsTestInnerGroupByPreAggregatedMovedRows",
+"./tests/AggsTestGroupBySlidingWindow",
+"./tests/AggsTestGroupByWindowSessionTimeZone",
+"./tests/AggsTestGroupByDeleteEmptyGroups",
+"./tests/AggsTestGroupByTopN",
+"./tests/AggsTestGroupByTopNTies",
+"./tests/AggsTestCube",
+"./tests/AggsTestGroupByGroupByFused",
+"./tests/AggsTestInnerGroupByLeftSequential",
+"./tests/AggsTestLeftGroupBySharedStaging",
+"./tests/AggsTestInnerGroupByMetrics",
+"./tests/AggsTestGroupByHooks",
+"./tests/AggsTestGroupByReplayedBatch"
 ]
 
 index = 0
@@ -1,9 +1,21 @@
 from databricks.sdk.runtime import *
 from pyspark.sql import functions as F
+from pyspark.sql import Column
+from pyspark.sql.types import MapType
+from pyspark.sql.utils import AnalysisException
+import math
 import os
+import re
 import hashlib
 from delta.tables import *
 from pyspark import StorageLevel
+import elzyme.utils
+import elzyme.metrics
+from elzyme.kv import KeyValueSink
+from elzyme.txn import MergeTransaction
+from elzyme.minmax import MinMaxState
+from elzyme.scheduler import StageGate
+from elzyme.staging import StagingRegistry
 
 class GroupByWithAggs:
   _groupBy = None
@@ -13,10 +25,18 @@ class GroupByWithAggs:
   _updateDict = None
   _dependentQuery = None
   _upstreamJoinCond = None
+  _retractableAggs = None
+  _sketchAggs = None
+  _bucketAggs = None
+  _deleteEmptyGroups = False
 
   def __init__(self, groupBy, aggCols, updateDict = None):
     self._groupBy = groupBy
-    self._aggCols = aggCols
+    self._retractableAggs = [ac for ac in aggCols if isinstance(ac, retractableMax)]
+    self._sketchAggs = [ac for ac in aggCols if isinstance(ac, (sketchCountDistinct, sketchPercentile))]
+    self._aggCols = [(ac.toColumn() if isinstance(ac, (retractableMax, sketchCountDistinct, sketchPercentile)) else ac) for ac in aggCols]
+    # keyed by the column's expression rather than its identity, so the builder's fingerprint does not depend on object ids
+    self._bucketAggs = {str(c): ac for ac, c in zip(aggCols, self._aggCols) if isinstance(ac, sketchPercentile)}
     self._updateDict = updateDict
     self._stream = groupBy.stream()
 
@@ -41,38 +61,173 @@ class GroupByWithAggs:
     dir = os.path.dirname(self._stream.path())
     return f'{dir}/{self.generateStagingName()}'
 
-  def _doMerge(self, deltaTable, cond, updateCols, insertCols, keyCols, aggCols, nullAggColsDf, deltaCalcs, batchDf, batchId):
-    plusDf = batchDf.where("_change_type != 'update_preimage'").groupBy(*self._groupBy.columns()).agg(*self._aggCols).alias("p").persist(StorageLevel.MEMORY_AND_DISK)
-    minusDf = batchDf.where("_change_type = 'update_preimage'").groupBy(*self._groupBy.columns()).agg(*self._aggCols).alias("m").persist(StorageLevel.MEMORY_AND_DISK)
-    batchDf = F.broadcast(plusDf).join(minusDf, F.expr(" AND ".join([f"p.{k} <=> m.{k}" for k in keyCols])), how="left")
-    batch_mdf = F.broadcast(minusDf).join(plusDf, F.expr(" AND ".join([f"p.{k} <=> m.{k}" for k in keyCols])), how="left_anti").crossJoin(nullAggColsDf.alias("p"))
-    batchDf = batchDf.select([f"p.{k}" for k in keyCols] + [deltaCalcs[ac] for ac in deltaCalcs])
-    batch_mdf = batch_mdf.select([f"m.{k}" for k in keyCols] + [deltaCalcs[ac] for ac in deltaCalcs])
-    batchDf = batchDf.unionByName(batch_mdf)
-    mergeChain = deltaTable.alias("u").merge(
-        source = batchDf.alias("staged_updates"),
-        condition = F.expr(cond))
-    mergeChain.whenMatchedUpdate(set = updateCols) \
-        .whenNotMatchedInsert(values = insertCols) \
-        .execute()
-    plusDf.unpersist()
-    minusDf.unpersist()
-
-  def _writeToTarget(self, deltaTableForFunc, tableName, path):
-    from elzyme.streams import DataStreamWriter
-    schemaDf = self._stream.static().groupBy(*self._groupBy.columns()).agg(*self._aggCols)
+  def _stagingFingerprint(self, stagingPath, *options):
+    return elzyme.utils.fingerprint(stagingPath, self, *options)
+
+  def _doMerge(self, deltaTable, cond, updateCols, insertCols, keyCols, aggCols, mergeAggCols, nullAggColsDf, deltaCalcs, signedAggCols, deleteEmptyGroups, partitionColumnsExprFunc, minMaxStates, batchDf, batchId):
+    sourceBatchDf = batchDf
+    persisted = []
+    with elzyme.metrics.phase('aggregateDeltas', batch=sourceBatchDf) as p:
+      paneCols = self._groupBy.paneColumns() if signedAggCols is not None else None
+      if paneCols is not None:
+        # each row is aggregated once into its slide pane, the pane partials are then added up for every window covering the pane
+        partialDf = self._groupBy.preparePanes(batchDf).groupBy(*paneCols).agg(*signedAggCols)
+        batchDf = self._groupBy.fanOut(partialDf).groupBy(*self._groupBy.columns()).agg(*[F.sum(c).cast(partialDf.schema[c].dataType).alias(c) for c in partialDf.columns[len(paneCols):]])
+      else:
+        batchDf = self._groupBy.prepare(batchDf)
+      if signedAggCols is not None:
+        if paneCols is None:
+          batchDf = batchDf.groupBy(*self._groupBy.columns()).agg(*signedAggCols)
+        signedNames = batchDf.columns
+        batchDf = batchDf.select([F.col(k) for k in keyCols] + [(F.col(ac) if ac in signedNames else deltaCalcs[ac]) for ac in deltaCalcs])
+      else:
+        plusDf = self._aggregate(batchDf.where("_change_type != 'update_preimage'"), mergeAggCols).alias("p").persist(StorageLevel.MEMORY_AND_DISK)
+        minusDf = self._aggregate(batchDf.where("_change_type = 'update_preimage'"), mergeAggCols).alias("m").persist(StorageLevel.MEMORY_AND_DISK)
+        persisted = [plusDf, minusDf]
+        batchDf = F.broadcast(plusDf).join(minusDf, F.expr(" AND ".join([f"p.{k} <=> m.{k}" for k in keyCols])), how="left")
+        batch_mdf = F.broadcast(minusDf).join(plusDf, F.expr(" AND ".join([f"p.{k} <=> m.{k}" for k in keyCols])), how="left_anti").crossJoin(nullAggColsDf.alias("p"))
+        batchDf = batchDf.select([f"p.{k}" for k in keyCols] + [deltaCalcs[ac] for ac in deltaCalcs])
+        batch_mdf = batch_mdf.select([f"m.{k}" for k in keyCols] + [deltaCalcs[ac] for ac in deltaCalcs])
+        batchDf = batchDf.unionByName(batch_mdf)
+      p.output('deltas', batchDf)
+    if len(minMaxStates) > 0:
+      with elzyme.metrics.phase('minMaxState', batch=sourceBatchDf, deltas=batchDf) as p:
+        for state in minMaxStates:
+          batchDf = state.apply(sourceBatchDf, batchDf, batchId)
+        p.output('deltasWithExtremes', batchDf)
+    if partitionColumnsExprFunc is not None:
+      with elzyme.metrics.phase('partitionPrune', deltas=batchDf):
+        partitionFilter = partitionColumnsExprFunc(batchDf)
+      if partitionFilter is not None and len(partitionFilter) > 0:
+        cond = f'({partitionFilter}) AND ({cond})'
+    with elzyme.metrics.phase('mergeExecute', deltas=batchDf):
+      mergeChain = deltaTable.alias("u").merge(
+          source = batchDf.alias("staged_updates"),
+          condition = F.expr(cond))
+      if deleteEmptyGroups:
+        # a group whose contributing rows have all been retracted or moved to other groups is removed in the same MERGE
+        mergeChain = mergeChain.whenMatchedDelete(condition = "u.__rows + staged_updates.__rows <= 0")
+      mergeChain.whenMatchedUpdate(set = updateCols) \
+          .whenNotMatchedInsert(condition = "staged_updates.__rows > 0" if deleteEmptyGroups else None, values = insertCols) \
+          .execute()
+    for df in persisted:
+      df.unpersist()
+    for state in minMaxStates:
+      state.cleanup()
+
+  def _aggregate(self, df, aggCols):
+    # Percentile sketches are built from per bucket counts aggregated separately and joined back by key,
+    # the other aggregates are computed in one pass. Columns keep the order of aggCols
+    bucketCols = [ac for ac in aggCols if str(ac) in self._bucketAggs]
+    if len(bucketCols) == 0:
+      return df.groupBy(*self._groupBy.columns()).agg(*aggCols)
+    keyNames = self._groupBy.keyNames()
+    otherCols = [ac for ac in aggCols if str(ac) not in self._bucketAggs]
+    aggDf = df.groupBy(*self._groupBy.columns()).agg(*(otherCols if len(otherCols) > 0 else [F.count(F.lit(1)).alias('__n')]))
+    otherNames = iter(aggDf.columns[len(keyNames):])
+    names = [(self._bucketAggs[str(ac)].sketchName() if str(ac) in self._bucketAggs else next(otherNames)) for ac in aggCols]
+    aggDf = aggDf.alias('__a')
+    for i, ac in enumerate(bucketCols):
+      sa = self._bucketAggs[str(ac)]
+      sketchDf = sa.aggregate(df, self._groupBy.columns(), keyNames).alias(f'__s{i}')
+      aggDf = aggDf.join(sketchDf, F.expr(' AND '.join([f'__a.{k} <=> __s{i}.{k}' for k in keyNames])), 'left') \
+                   .select('__a.*', F.coalesce(F.col(f'__s{i}.{sa.sketchName()}'), F.expr('cast(map() AS map<int,bigint>)')).alias(sa.sketchName())) \
+                   .alias('__a')
+    return aggDf.select(*keyNames, *names)
+
+  def _decomposeAlgebraicAggs(self, names, targetColumns = None):
+    # a bare avg is merged through sum and count state columns, stddev and variance through count, mean and M2,
+    # unless the column already has a hand written reduce() expression or the existing target was created without the state
+    algebraicAggs = []
+    mergeAggCols = []
+    for ac, name in zip(self._aggCols, names):
+      aa = None
+      if self._updateDict is None or name not in self._updateDict:
+        aa = AlgebraicAgg.fromColumn(ac, name)
+      if aa is not None and targetColumns is not None and not all(c in targetColumns for c in aa.stateNames()):
+        aa = None
+      if aa is None:
+        mergeAggCols.append(ac)
+      else:
+        algebraicAggs.append(aa)
+        mergeAggCols.extend(aa.stateColumns())
+    return algebraicAggs, mergeAggCols
+
+  def _signedAggCols(self, mergeAggCols, mergeSchemaDf):
+    # sum and count deltas can be computed in one pass by weighting preimage rows with -1,
+    # any other aggregate needs the plus and minus sides aggregated separately
+    if len(self._retractableAggs) > 0 or len(self._sketchAggs) > 0:
+      return None
+    sign = "CASE WHEN _change_type = 'update_preimage' THEN -1 ELSE 1 END"
+    signedAggCols = []
+    for ac, field in zip(mergeAggCols, mergeSchemaDf.schema.fields[len(self._groupBy.columns()):]):
+      call = AlgebraicAgg.parseCall(ac)
+      if call is None or (self._updateDict is not None and field.name in self._updateDict):
+        return None
+      func, inner = call
+      dataType = field.dataType.simpleString()
+      if func == 'count':
+        signed = f'sum(CASE WHEN ({inner}) is null THEN 0 ELSE {sign} END)'
+      elif func == 'sum':
+        value = f'CAST({inner} AS double)' if dataType == 'double' else f'({inner})'
+        signed = f'sum({value} * {sign})'
+      else:
+        return None
+      signedAggCols.append(F.expr(f'CAST({signed} AS {dataType})').alias(field.name))
+    return signedAggCols
+
+  def _writeToTarget(self, deltaTableForFunc, tableName, path, keyValueSink = None, deleteEmptyGroups = None, countRows = False):
+    from elzyme.streams import DataStreamWriter, PartitionColumn, prune
+    staticDf = self._groupBy.prepare(self._stream.static())
+    schemaDf = staticDf.groupBy(*self._groupBy.columns()).agg(*self._aggCols)
+    try:
+      targetColumns = deltaTableForFunc().toDF().columns
+    except Exception:
+      targetColumns = None
+    algebraicAggs, mergeAggCols = self._decomposeAlgebraicAggs(schemaDf.columns[len(self._groupBy.columns()):], targetColumns)
+    if deleteEmptyGroups is None:
+      deleteEmptyGroups = self._deleteEmptyGroups
+    countRows = deleteEmptyGroups or countRows
+    if countRows and targetColumns is not None:
+      # targets created before the hidden row count existed keep their empty groups
+      countRows = '__rows' in targetColumns
+    deleteEmptyGroups = deleteEmptyGroups and countRows
+    if countRows:
+      mergeAggCols = mergeAggCols + [F.count(F.lit(1)).alias('__rows')]
+    schemaDf = staticDf.groupBy(*self._groupBy.columns()).agg(*mergeAggCols)
+    signedAggCols = self._signedAggCols(mergeAggCols, schemaDf)
+    derivedCols = {sa.sketchName(): (sa.name(), sa.estimateSql(sa.sketchName())) for sa in self._sketchAggs}
+    derivedCols.update({aa.stateNames()[0]: (aa.name(), aa.estimateSql(lambda c: c)) for aa in algebraicAggs})
+    stateCols = [sa.sketchName() for sa in self._sketchAggs] + [c for aa in algebraicAggs for c in aa.stateNames()]
+    if len(stateCols) > 0:
+      # the derived column takes the place of its first state column and the state columns themselves are kept at the end of the row
+      schemaDf = schemaDf.select([(F.expr(derivedCols[c][1]).alias(derivedCols[c][0]) if c in derivedCols else F.col(c)) for c in schemaDf.columns if c in derivedCols or c not in stateCols] + stateCols)
     keyCols = schemaDf.columns[:len(self._groupBy.columns())]
     aggCols = schemaDf.columns[len(self._groupBy.columns()):]
     if self._updateDict is not None:
       schemaDf = schemaDf.alias("u").join(schemaDf.alias("staged_updates")).select([f"u.{c}" for c in keyCols + aggCols if c not in self._updateDict] + [(self._updateDict[k][1]).alias(k) for k in self._updateDict])
+    if self._partitionColumns is not None:
+      for pc in self._partitionColumns:
+        if pc.column() not in keyCols:
+          raise Exception(f'Partition column {pc.column()} must be one of the groupBy columns {keyCols}')
     ddl = schemaDf.schema.toDDL()
     createSql = f'CREATE TABLE IF NOT EXISTS {tableName}({ddl}) USING DELTA TBLPROPERTIES (delta.enableChangeDataFeed = true, delta.autoOptimize.autoCompact = true, delta.autoOptimize.optimizeWrite = true)'
     if path is not None:
       createSql = f"{createSql} LOCATION '{path}'"
     if self._partitionColumns is not None:
       createSql = f"{createSql} PARTITIONED BY ({', '.join([pc.column() for pc in self._partitionColumns])})"
+    elif len(self._groupBy.windows()) > 0:
+      createSql = f"{createSql} CLUSTER BY ({', '.join([w.startName() for w in self._groupBy.windows()])})"
     spark.sql(createSql)
     cond = " AND ".join([f"u.{kc} <=> staged_updates.{kc}" for kc in keyCols])
+    partitionColumnsExprFunc = None
+    prunedPartitionColumns = []
+    if self._partitionColumns is not None:
+      prunedPartitionColumns = [pc for pc in self._partitionColumns if pc.isStaticPruned()]
+    # merges only touch the windows present in the batch whether or not the window start is a partition column
+    prunedPartitionColumns += [PartitionColumn(prune(w.startName())) for w in self._groupBy.windows() if w.startName() not in [pc.column() for pc in prunedPartitionColumns]]
+    if len(prunedPartitionColumns) > 0:
+      partitionColumnsExprFunc = lambda df: elzyme.utils.partitionPruneCondition(df, prunedPartitionColumns, False)
     deltaCalcs = {ac: F.expr(f"CASE WHEN m.{ac} is not null THEN COALESCE(p.{ac}, 0) - m.{ac} ELSE p.{ac} END as {ac}") for ac in aggCols}
     updateCols = {ac: F.col(f'u.{ac}') + F.col(f'staged_updates.{ac}') for ac in aggCols}
     insertCols = {ic: F.col(f'staged_updates.{ic}') for ic in (keyCols + aggCols)}
@@ -81,19 +236,98 @@ class GroupByWithAggs:
         updateCols[k] = self._updateDict[k][1]
         insertCols[k] = self._updateDict[k][0]
         deltaCalcs[k] = F.when(F.col(f"m.{k}").isNotNull(), self._updateDict[k][2]).otherwise(F.col(f"p.{k}")).alias(f"{k}")
+    for sa in self._sketchAggs:
+      sketch = sa.sketchName()
+      merged = sa.mergeSql(f'u.{sketch}', f'staged_updates.{sketch}')
+      inserted = sa.mergeSql('NULL', f'staged_updates.{sketch}')
+      deltaCalcs[sketch] = F.expr(sa.deltaSql(f'p.{sketch}', f'm.{sketch}')).alias(sketch)
+      deltaCalcs[sa.name()] = F.lit(None).cast(sa.estimateType()).alias(sa.name())
+      updateCols[sketch] = F.expr(merged)
+      updateCols[sa.name()] = F.expr(sa.estimateSql(merged))
+      insertCols[sketch] = F.expr(inserted)
+      insertCols[sa.name()] = F.expr(sa.estimateSql(inserted))
+    for aa in algebraicAggs:
+      merged = aa.mergeSqls(lambda c: f'u.{c}', lambda c: f'staged_updates.{c}')
+      inserted = aa.mergeSqls(lambda c: 'NULL', lambda c: f'staged_updates.{c}')
+      for c, sql in aa.deltaSqls().items():
+        deltaCalcs[c] = F.expr(sql).alias(c)
+      for c in aa.stateNames():
+        updateCols[c] = F.expr(merged[c])
+        insertCols[c] = F.expr(inserted[c])
+      deltaCalcs[aa.name()] = F.lit(None).cast(schemaDf.schema[aa.name()].dataType).alias(aa.name())
+      updateCols[aa.name()] = F.expr(aa.estimateSql(lambda c: merged[c]))
+      insertCols[aa.name()] = F.expr(aa.estimateSql(lambda c: inserted[c]))
+    mergeTransaction = MergeTransaction(tableName)
+    minMaxStates = []
+    if len(self._retractableAggs) > 0:
+      location = deltaTableForFunc().detail().select('location').collect()[0][0]
+      for ra in self._retractableAggs:
+        # retractable aggregates are overwritten with the extreme kept in their state table rather than added as deltas
+        updateCols[ra.name()] = F.col(f'staged_updates.{ra.name()}')
+        minMaxStates.append(MinMaxState(ra, keyCols, self._groupBy, f'{os.path.dirname(location)}/$$_minmax_{os.path.basename(location)}_{ra.name()}', self._stream, mergeTransaction)
+                              .create(schemaDf.schema.fields[:len(keyCols)], schemaDf.schema[ra.name()].dataType))
     nullAggColsDf = spark.sql(f"SELECT {','.join([f'null as {a}' for a in aggCols])}")
     def mergeFunc(batchDf, batchId):
       batchDf._jdf.sparkSession().conf().set('spark.databricks.optimizer.adaptive.enabled', True)
       batchDf._jdf.sparkSession().conf().set('spark.sql.adaptive.forceApply', True)
-      deltaTable = deltaTableForFunc()
-      self._doMerge(deltaTable, cond, updateCols, insertCols, keyCols, aggCols, nullAggColsDf, deltaCalcs, batchDf, batchId)
+      deltaTable = deltaTableForFunc(batchDf.sparkSession)
+      # Aggregate merges are not idempotent, re-merging a replayed batch would double count it
+      if not mergeTransaction.isCommitted(deltaTable, batchId):
+        with elzyme.metrics.phase('merge', batch=batchDf):
+          mergeTransaction.run(batchDf, batchId, lambda: self._doMerge(deltaTable, cond, updateCols, insertCols, keyCols, aggCols, mergeAggCols, nullAggColsDf, deltaCalcs, signedAggCols, deleteEmptyGroups, partitionColumnsExprFunc, minMaxStates, batchDf, batchId))
+        elzyme.metrics.countMerge(deltaTable, mergeTransaction, batchId)
+      if keyValueSink is not None:
+        keyValueSink.apply(deltaTable, tableName, keyCols, batchId, mergeTransaction)
+    stageGate = StageGate(mergeFunc)
     return DataStreamWriter(
       (
-        self._stream.stream().writeStream.foreachBatch(mergeFunc)
+        self._stream.stream().writeStream.foreachBatch(stageGate)
       )
-    )._chainStreamingQuery(self._dependentQuery, self._upstreamJoinCond)
+    )._chainStreamingQuery(self._dependentQuery, self._upstreamJoinCond)._addMergeTransaction(mergeTransaction)._addStageGate(stageGate)._setExplain(lambda: self._explainStage(tableName))
+
+  def _explainStage(self, tableName):
+    keyCols = self._groupBy.keyNames()
+    staticDf = self._groupBy.prepare(self._stream.static())
+    # the decomposition is recomputed here rather than read from a running stage, explain() leaves the stage untouched
+    algebraicAggs, mergeAggCols = self._decomposeAlgebraicAggs(staticDf.groupBy(*self._groupBy.columns()).agg(*self._aggCols).columns[len(self._groupBy.columns()):])
+    signedAggCols = self._signedAggCols(mergeAggCols, staticDf.groupBy(*self._groupBy.columns()).agg(*mergeAggCols))
+    lines = [f"aggregation of {self._stream.name()} by {keyCols} into {tableName if tableName is not None else '(no target yet)'}",
+             f'input {self._stream.name()}: {self._stream.sizeEstimate()}',
+             'aggregates: ' + ', '.join([(str(ac) if isinstance(ac, Column) else ac.name()) for ac in self._aggCols]),
+             'merge condition: ' + ' AND '.join([f'u.{kc} <=> staged_updates.{kc}' for kc in keyCols])]
+    for w in self._groupBy.windows():
+      lines.append(f'window {w.name()}: {w._windowSecs}s every {w._slideSecs}s')
+    if self._groupBy.groupingSets() is not None:
+      lines.append(f'grouping sets: {self._groupBy.groupingSets()}')
+    pruned = [pc.column() for pc in (self._partitionColumns or []) if pc.isStaticPruned()]
+    pruned += [w.startName() for w in self._groupBy.windows() if w.startName() not in pruned]
+    if self._partitionColumns is not None:
+      lines.append(f'partition columns: {[pc.column() for pc in self._partitionColumns]}')
+    if len(pruned) > 0:
+      lines.append(f'pruned columns: {pruned}')
+    if signedAggCols is not None and self._groupBy.paneColumns() is not None:
+      lines.append('strategy: sum and count deltas in a single signed aggregation pass per slide pane, added up per window')
+    elif signedAggCols is not None:
+      lines.append('strategy: sum and count deltas in a single signed aggregation pass')
+    else:
+      lines.append('strategy: inserted and retracted rows aggregated separately and subtracted')
+    if self._updateDict is not None:
+      lines.append(f'reduce() columns: {list(self._updateDict.keys())}')
+    if len(algebraicAggs) > 0:
+      lines.append(f'algebraic state columns: {[c for aa in algebraicAggs for c in aa.stateNames()]}')
+    if len(self._retractableAggs) > 0:
+      lines.append(f'min/max state tables: {[ra.name() for ra in self._retractableAggs]}')
+    if len(self._sketchAggs) > 0:
+      lines.append(f'sketch columns: {[sa.sketchName() for sa in self._sketchAggs]}')
+    lines.append(f'empty groups deleted: {self._deleteEmptyGroups}')
+    return lines
+
+  def explain(self):
+    stages = self._dependentQuery._explainStages() if self._dependentQuery is not None else []
+    print(elzyme.utils.formatStages(stages + [self._explainStage(None)]))
 
   def partitionBy(self, *columns):
+    from elzyme.streams import PartitionColumn
     self._partitionColumns = [(c if isinstance(c, PartitionColumn) else PartitionColumn(c)) for c in columns]
     return self
 
@@ -109,47 +343,522 @@ class GroupByWithAggs:
     self._updateDict[column] = (insert, update, delta_update)
     return self
 
+  def deleteEmptyGroups(self):
+    # opt-in, the target gets a hidden __rows count and groups whose rows are all gone are deleted instead of kept at zero
+    self._deleteEmptyGroups = True
+    return self
+
   def join(self, right, joinType = 'inner', stagingPath = None):
+    return self._join(right, joinType, stagingPath)
+
+  def _join(self, right, joinType, stagingPath, countRows = False):
     from elzyme.streams import Stream
     if stagingPath is None:
       stagingPath = self.generateStagingPath()
-    query = (
-                  self.writeToPath(f'{stagingPath}/data')
+    # Joins ignore deleted rows, so empty groups are kept in the staging table for the join to see them go to zero.
+    # Unless countRows passes the row count on, they are never removed from the join's target, where a dead group stays with its aggregates at zero
+    fingerprint = self._stagingFingerprint(stagingPath, countRows)
+    query = StagingRegistry.attach(fingerprint, stagingPath, lambda: (
+                  self._writeToTarget(lambda session = spark: DeltaTable.forPath(session, f'{stagingPath}/data'), f'delta.`{stagingPath}/data`', f'{stagingPath}/data', deleteEmptyGroups = False, countRows = countRows)
                       .option('checkpointLocation', f'{stagingPath}/cp')
                       .queryName(self.generateStagingName())
-                )
-    return ( Stream.fromPath(f'{stagingPath}/data').setName(self.generateStagingName()).primaryKeys(*self._groupBy.columns())
+                ))
+    return ( Stream.fromPath(f'{stagingPath}/data').setName(self.generateStagingName()).primaryKeys(*self._groupBy.keyNames()).setSource(('stage', fingerprint))
                .join(right, joinType)
                ._chainStreamingQuery(query, None) )
   
 
-  def groupBy(self, *cols, stagingPath = None):
+  def _fuse(self, cols, aggCols):
+    # sum of sums and sum of counts over coarser keys equal the sum and count over the source rows, so such a
+    # second level can aggregate the first level's source deltas directly instead of reading back its staging table
+    if len(self._groupBy.windows()) > 0 or self._groupBy.groupingSets() is not None:
+      return None
+    if not all(isinstance(c, str) and c in self._groupBy.keyNames() for c in cols):
+      return None
+    firstDf = self._stream.static().groupBy(*self._groupBy.columns()).agg(*self._aggCols)
+    names = firstDf.columns[len(self._groupBy.columns()):]
+    additive = {}
+    for ac, name in zip(self._aggCols, names):
+      call = AlgebraicAgg.parseCall(ac)
+      if call is not None and call[0] in ['sum', 'count'] and (self._updateDict is None or name not in self._updateDict):
+        additive[name] = call
+    fusedNames = firstDf.groupBy(*cols).agg(*aggCols).columns[len(cols):]
+    fusedAggCols = []
+    for ac, name in zip(aggCols, fusedNames):
+      call = AlgebraicAgg.parseCall(ac)
+      if call is None or call[0] != 'sum' or call[1] not in additive:
+        return None
+      func, inner = additive[call[1]]
+      fusedAggCols.append(F.expr(f'{func}({inner})').alias(name))
+    return GroupBy(self._stream, cols)._chainStreamingQuery(self._dependentQuery, self._upstreamJoinCond).agg(*fusedAggCols)
+
+  def groupBy(self, *cols, stagingPath = None, fuse = False):
+    # opt-in, a fused chain checkpoints a different query than the staged chain a running pipeline was started with
+    if fuse and stagingPath is None:
+      return FusedGroupBy(self, cols)
+    return self._stagedGroupBy(cols, stagingPath)
+
+  def _stagedGroupBy(self, cols, stagingPath = None):
+    from elzyme.streams import Stream
     if stagingPath is None:
       stagingPath = self.generateStagingPath()
-    query = (
+    fingerprint = self._stagingFingerprint(stagingPath)
+    query = StagingRegistry.attach(fingerprint, stagingPath, lambda: (
                   self.writeToPath(f'{stagingPath}/data')
                       .option('checkpointLocation', f'{stagingPath}/cp')
                       .queryName(self.generateStagingName())
-                )
-    return ( Stream.fromPath(f'{stagingPath}/data').setName(self.generateStagingName()).primaryKeys(*self._groupBy.columns())
+                ))
+    return ( Stream.fromPath(f'{stagingPath}/data', retractDeletes = True).setName(self.generateStagingName()).primaryKeys(*self._groupBy.keyNames()).setSource(('stage', fingerprint))
                .groupBy(*cols)
                ._chainStreamingQuery(query, None) )
 
   def writeToPath(self, path):
-      return self._writeToTarget(lambda: DeltaTable.forPath(spark, path), f'delta.`{path}`', path)
+      return self._writeToTarget(lambda session = spark: DeltaTable.forPath(session, path), f'delta.`{path}`', path)
 
   def writeToTable(self, tableName):
-    return self._writeToTarget(lambda: DeltaTable.forName(spark, tableName), tableName, None)
+    return self._writeToTarget(lambda session = spark: DeltaTable.forName(session, tableName), tableName, None)
+
+  def writeToKeyValue(self, kvPath, path = None, tableName = None):
+    if path is not None:
+      return self._writeToTarget(lambda session = spark: DeltaTable.forPath(session, path), f'delta.`{path}`', path, KeyValueSink(kvPath))
+    if tableName is not None:
+      return self._writeToTarget(lambda session = spark: DeltaTable.forName(session, tableName), tableName, None, KeyValueSink(kvPath))
+    raise Exception('Either path or tableName of the Delta target backing the key-value store must be specified')
+
+class AlgebraicAgg:
+  _func = None
+  _expr = None
+  _name = None
+  functions = ['avg', 'mean', 'stddev', 'stddev_samp', 'std', 'stddev_pop', 'variance', 'var_samp', 'var_pop']
+  aggregateFunctions = {'Average': 'avg', 'Sum': 'sum', 'Count': 'count', 'StddevSamp': 'stddev_samp', 'StddevPop': 'stddev_pop', 'VarianceSamp': 'var_samp', 'VariancePop': 'var_pop'}
+
+  def __init__(self, func, expr, name):
+    self._func = func
+    self._expr = expr
+    self._name = name
+
+  @staticmethod
+  def parseCall(column):
+    # Only a bare aggregate call, optionally aliased, is recognized. It is read from the column's expression tree,
+    # F.avg builds a resolved aggregate on some Spark versions and F.expr('avg(...)') an unresolved function call
+    if not isinstance(column, Column) or not hasattr(column, '_jc'):
+      return None
+    try:
+      expr = column._jc.expr()
+      if expr.getClass().getSimpleName() == 'Alias':
+        expr = expr.child()
+      kind = expr.getClass().getSimpleName()
+      if kind == 'UnresolvedFunction':
+        if expr.isDistinct() or expr.filter().isDefined() or expr.arguments().size() != 1:
+          return None
+        func = expr.nameParts().last().lower()
+        arg = expr.arguments().head()
+      elif kind == 'AggregateExpression':
+        aggregateFunction = expr.aggregateFunction()
+        if expr.isDistinct() or expr.filter().isDefined() or aggregateFunction.children().size() != 1:
+          return None
+        func = AlgebraicAgg.aggregateFunctions.get(aggregateFunction.getClass().getSimpleName())
+        arg = aggregateFunction.children().head()
+      else:
+        return None
+      if func is None:
+        return None
+      return (func, arg.sql())
+    except Exception:
+      # an expression tree this Spark version shapes differently is merged like any other aggregate
+      return None
+
+  @staticmethod
+  def fromColumn(column, name):
+    call = AlgebraicAgg.parseCall(column)
+    if call is None or call[0] not in AlgebraicAgg.functions:
+      return None
+    return AlgebraicAgg(call[0], call[1], name)
+
+  def name(self):
+    return self._name
+
+  def _isVariance(self):
+    return self._func not in ['avg', 'mean']
+
+  def stateNames(self):
+    prefix = re.sub(r'\W', '_', self._name)
+    if self._isVariance():
+      return [f'__count_{prefix}', f'__mean_{prefix}', f'__m2_{prefix}']
+    return [f'__sum_{prefix}', f'__count_{prefix}']
+
+  def retractedNames(self):
+    # the retracted side of a batch is staged next to the inserted side, variance state cannot be subtracted column by column
+    if not self._isVariance():
+      return []
+    prefix = re.sub(r'\W', '_', self._name)
+    return [f'__rcount_{prefix}', f'__rmean_{prefix}', f'__rm2_{prefix}']
+
+  def stateColumns(self):
+    names = self.stateNames()
+    if not self._isVariance():
+      return [F.expr(f'sum({self._expr})').alias(names[0]), F.expr(f'count({self._expr})').alias(names[1])]
+    value = f'CAST({self._expr} AS double)'
+    return [F.expr(f'count({self._expr})').alias(names[0]),
+            F.expr(f'avg({value})').alias(names[1]),
+            F.expr(f'coalesce(var_pop({value}) * count({self._expr}), 0D)').alias(names[2])]
+
+  def deltaSqls(self):
+    # inserted (p) and retracted (m) sides of a batch, state without its own entry is subtracted like any other column
+    if not self._isVariance():
+      return {}
+    n, mean, m2 = self.stateNames()
+    rn, rmean, rm2 = self.retractedNames()
+    return {n: f'coalesce(p.{n}, 0)', mean: f'p.{mean}', m2: f'coalesce(p.{m2}, 0D)',
+            rn: f'coalesce(m.{n}, 0)', rmean: f'm.{mean}', rm2: f'coalesce(m.{m2}, 0D)'}
+
+  @staticmethod
+  def _combine(na, ma, m2a, nb, mb, m2b):
+    # Chan et al. pairwise update of (count, mean, M2). It also holds for a negative count, which retracts a group of rows
+    n = f'({na} + {nb})'
+    delta = f'({mb} - {ma})'
+    mean = f'(CASE WHEN {n} = 0 THEN 0D ELSE {ma} + {delta} * {nb} / {n} END)'
+    m2 = f'(CASE WHEN {n} = 0 THEN 0D ELSE {m2a} + {m2b} + {delta} * {delta} * {na} * {nb} / {n} END)'
+    return n, mean, m2
+
+  def mergeSqls(self, target, staged):
+    # state of a group after adding the staged changes to the target's state, target and staged map a state name to its column
+    names = self.stateNames()
+    if not self._isVariance():
+      return {c: f'(coalesce({target(c)}, 0) + coalesce({staged(c)}, 0))' for c in names}
+    n, mean, m2 = names
+    rn, rmean, rm2 = self.retractedNames()
+    count = lambda c: f'CAST(coalesce({c}, 0) AS double)'
+    stat = lambda c: f'coalesce({c}, 0D)'
+    na, ma, m2a = self._combine(count(target(n)), stat(target(mean)), stat(target(m2)), count(staged(n)), stat(staged(mean)), stat(staged(m2)))
+    nb, mb, m2b = self._combine(na, ma, m2a, f'(-{count(staged(rn))})', stat(staged(rmean)), f'(-{stat(staged(rm2))})')
+    return {n: f'(coalesce({target(n)}, 0) + coalesce({staged(n)}, 0) - coalesce({staged(rn)}, 0))',
+            mean: f'(CASE WHEN {nb} > 0 THEN {mb} END)',
+            m2: f'greatest({m2b}, 0D)'}
+
+  def estimateSql(self, ref):
+    names = self.stateNames()
+    if not self._isVariance():
+      s = ref(names[0])
+      n = ref(names[1])
+      return f'CASE WHEN {n} > 0 THEN {s} / {n} END'
+    n = ref(names[0])
+    m2 = ref(names[2])
+    if self._func.endswith('_pop'):
+      variance = f'CASE WHEN {n} > 0 THEN {m2} / {n} END'
+    else:
+      variance = f'CASE WHEN {n} > 1 THEN {m2} / ({n} - 1) END'
+    return f'sqrt({variance})' if self._func.startswith('std') else variance
+
+class retractableMax:
+  _column = None
+  _name = None
+  _bufferSize = None
+
+  def __init__(self,
+               column,
+               bufferSize = 16):
+    self._column = column
+    self._bufferSize = bufferSize
+
+  def alias(self, name):
+    self._name = name
+    return self
+
+  def name(self):
+    if self._name is None:
+      return f'{self._aggName()}({self._column})'
+    return self._name
+
+  def valueColumn(self):
+    return F.col(self._column) if isinstance(self._column, str) else self._column
+
+  def bufferSize(self):
+    return self._bufferSize
+
+  def isMin(self):
+    return False
+
+  def _aggName(self):
+    return 'max'
+
+  def toColumn(self):
+    return F.max(self.valueColumn()).alias(self.name())
+
+class retractableMin(retractableMax):
+  def isMin(self):
+    return True
+
+  def _aggName(self):
+    return 'min'
+
+  def toColumn(self):
+    return F.min(self.valueColumn()).alias(self.name())
+
+class sketchCountDistinct:
+  _column = None
+  _name = None
+  _lgConfigK = None
+
+  def __init__(self,
+               column,
+               lgConfigK = 12):
+    self._column = column
+    self._lgConfigK = lgConfigK
+
+  def alias(self, name):
+    self._name = name
+    return self
+
+  def name(self):
+    if self._name is None:
+      return f'count_distinct_{self._column}'
+    return self._name
+
+  def sketchName(self):
+    return f'__hll_{self.name()}'
+
+  def toColumn(self):
+    return F.expr(f'hll_sketch_agg({self._column}, {self._lgConfigK})').alias(self.sketchName())
+
+  def estimateType(self):
+    return 'bigint'
+
+  def estimateSql(self, sketch):
+    return f'coalesce(hll_sketch_estimate({sketch}), 0)'
+
+  def deltaSql(self, plus, minus):
+    # HLL sketches cannot subtract, so retracted rows are left in them and only new rows are unioned in
+    return f'CAST({plus} AS binary)'
+
+  def mergeSql(self, target, staged):
+    return f'CASE WHEN {target} is null THEN {staged} WHEN {staged} is null THEN {target} ELSE hll_union({target}, {staged}, true) END'
+
+class sketchPercentile:
+  _column = None
+  _name = None
+  _percentiles = None
+  _relativeAccuracy = None
+  _gamma = None
+  # bucket indexes of positive values are shifted by this offset and negative values use the negated key, so keys sort like the values
+  _offset = 1 << 20
+
+  def __init__(self,
+               column,
+               percentiles = [0.5, 0.95, 0.99],
+               relativeAccuracy = 0.01):
+    self._column = column
+    self._percentiles = percentiles if isinstance(percentiles, list) else [percentiles]
+    self._relativeAccuracy = relativeAccuracy
+    self._gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy)
+
+  def alias(self, name):
+    self._name = name
+    return self
+
+  def name(self):
+    if self._name is None:
+      return f'percentiles_{self._column}'
+    return self._name
+
+  def sketchName(self):
+    return f'__dds_{self.name()}'
+
+  def _bucketSql(self):
+    v = f'CAST({self._column} AS double)'
+    index = f'CAST(ceil(ln(abs({v})) / ln({self._gamma})) AS int) + {self._offset}'
+    return f'CASE WHEN {v} is null THEN null WHEN abs({v}) < 1e-9 THEN 0 WHEN {v} > 0 THEN {index} ELSE -({index}) END'
+
+  def _valueSql(self, key):
+    value = f'2 * pow({self._gamma}, abs({key}) - {self._offset}) / ({self._gamma} + 1)'
+    return f'CASE WHEN {key} = 0 THEN 0D WHEN {key} > 0 THEN {value} ELSE -{value} END'
+
+  def toColumn(self):
+    # The sketch is a DDSketch style map of logarithmic buckets to counts. Bucket counts add and subtract,
+    # so unlike HLL or KLL sketches retracted rows are removed exactly and the relative error bound still holds.
+    # This single aggregate defines the column and its type, batches are aggregated with aggregate() instead
+    keys = f'collect_list({self._bucketSql()})'
+    return F.expr(f'aggregate({keys}, cast(map() AS map<int,bigint>), (acc, k) -> map_concat(map_filter(acc, (kk, v) -> kk != k), map(k, coalesce(try_element_at(acc, k), 0L) + 1L)))').alias(self.sketchName())
+
+  def aggregate(self, df, groupCols, keyNames):
+    # counting rows per group and bucket first leaves one entry per bucket to collect into the map
+    return (
+      df.groupBy(*groupCols, F.expr(self._bucketSql()).alias('__bucket')).count()
+        .where('__bucket is not null')
+        .groupBy(*keyNames)
+        .agg(F.map_from_entries(F.collect_list(F.struct('__bucket', 'count'))).alias(self.sketchName()))
+    )
+
+  def estimateType(self):
+    return 'array<double>'
+
+  def estimateSql(self, sketch):
+    entries = f'array_sort(map_entries(map_filter({sketch}, (k, v) -> v > 0)))'
+    # running counts in one pass over the sorted buckets
+    cumulative = f"aggregate({entries}, named_struct('total', 0L, 'cums', cast(array() AS array<struct<key:int,cum:bigint>>)), (acc, e) -> named_struct('total', acc.total + e.value, 'cums', concat(acc.cums, array(named_struct('key', e.key, 'cum', acc.total + e.value))))).cums"
+    total = f'aggregate(map_values(map_filter({sketch}, (k, v) -> v > 0)), 0L, (a, x) -> a + x)'
+    percentiles = ', '.join([f'{p}D' for p in self._percentiles])
+    return f"CASE WHEN {total} < 1 THEN null ELSE transform(array({percentiles}), q -> {self._valueSql(f'filter({cumulative}, c -> c.cum > q * ({total} - 1))[0].key')}) END"
+
+  def _addSql(self, a, b):
+    return f'map_filter(map_zip_with(coalesce({a}, cast(map() AS map<int,bigint>)), coalesce({b}, cast(map() AS map<int,bigint>)), (k, x, y) -> coalesce(x, 0L) + coalesce(y, 0L)), (k, v) -> v != 0)'
+
+  def deltaSql(self, plus, minus):
+    return self._addSql(plus, f'transform_values({minus}, (k, v) -> -v)')
+
+  def mergeSql(self, target, staged):
+    return f'map_filter({self._addSql(target, staged)}, (k, v) -> v > 0)'
+
+class window:
+  _column = None
+  _name = None
+  _windowSecs = None
+  _slideSecs = None
+  _units = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400, 'week': 604800}
+
+  def __init__(self,
+               column,
+               windowDuration,
+               slideDuration = None):
+    self._column = column
+    self._windowSecs = window._durationSecs(windowDuration)
+    self._slideSecs = self._windowSecs if slideDuration is None else window._durationSecs(slideDuration)
+    if self._slideSecs > self._windowSecs:
+      raise Exception(f'Slide duration {slideDuration} must not be longer than window duration {windowDuration}')
+
+  @staticmethod
+  def _durationSecs(duration):
+    m = re.fullmatch(r'\s*(\d+)\s*(second|minute|hour|day|week)s?\s*', duration.lower())
+    if m is None:
+      raise Exception(f'Unsupported window duration {duration}, expected a number followed by seconds, minutes, hours, days or weeks')
+    return int(m.group(1)) * window._units[m.group(2)]
+
+  def alias(self, name):
+    self._name = name
+    return self
+
+  def name(self):
+    if self._name is None:
+      return 'window'
+    return self._name
+
+  def startName(self):
+    return f'{self.name()}_start'
+
+  def endName(self):
+    return f'{self.name()}_end'
+
+  def _paneName(self):
+    return f'__{self.name()}_pane'
+
+  def _sliceName(self):
+    return f'__{self.name()}_slice'
+
+  def _sliceSecs(self):
+    # window and slide are both multiples of the slice, so every row of a slice falls in the same windows
+    return math.gcd(self._windowSecs, self._slideSecs)
+
+  def isSliding(self):
+    return self._windowSecs != self._slideSecs
+
+  def assignSlice(self, df):
+    ts = F.col(self._column) if isinstance(self._column, str) else self._column
+    return df.withColumn(self._sliceName(), F.floor(F.unix_timestamp(ts.cast('timestamp')) / self._sliceSecs()))
+
+  def fanOut(self, df):
+    # a slice starting at s belongs to the windows starting after s + slice - windowDuration and no later than s
+    sliceSecs = self._sliceSecs()
+    start = F.col(self._sliceName()) * sliceSecs
+    first = F.ceil((start + sliceSecs - self._windowSecs) / self._slideSecs)
+    last = F.floor(start / self._slideSecs)
+    return df.withColumn(self._paneName(), F.explode(F.sequence(first, last))).drop(self._sliceName())
+
+  def prepare(self, df):
+    # A row belongs to every window whose start is a multiple of the slide within the last window duration.
+    # Tumbling windows have exactly one, sliding windows fan each row out to windowDuration / slideDuration panes
+    ts = F.col(self._column) if isinstance(self._column, str) else self._column
+    secs = F.unix_timestamp(ts.cast('timestamp'))
+    first = F.floor((secs - self._windowSecs) / self._slideSecs) + 1
+    last = F.floor(secs / self._slideSecs)
+    if self._windowSecs == self._slideSecs:
+      return df.withColumn(self._paneName(), last)
+    return df.withColumn(self._paneName(), F.explode(F.sequence(first, last)))
+
+  def columns(self):
+    return [F.expr(f'timestamp_seconds({self._paneName()} * {self._slideSecs})').alias(self.startName()),
+            F.expr(f'timestamp_seconds({self._paneName()} * {self._slideSecs} + {self._windowSecs})').alias(self.endName())]
 
 class GroupBy:
   _cols = None
   _stream = None
   _dependentQuery = None
   _upstreamJoinCond = None
+  _windows = None
+  _keyNames = None
+  _groupingSets = None
+  _plainCols = None
 
-  def __init__(self, stream, cols):
-    self._cols = cols
+  def __init__(self, stream, cols, groupingSets = None):
+    self._windows = [c for c in cols if isinstance(c, window)]
+    self._plainCols = [c for c in cols if not isinstance(c, window)]
+    self._cols = [gc for c in cols for gc in (c.columns() if isinstance(c, window) else [c])]
+    self._keyNames = [kn for c in cols for kn in ([c.startName(), c.endName()] if isinstance(c, window) else [c])]
     self._stream = stream
+    if groupingSets is not None:
+      if len(self._windows) > 0 or not all(isinstance(c, str) for c in cols):
+        raise Exception('Grouping sets only support column names')
+      self._groupingSets = [list(gs) for gs in groupingSets]
+      # each batch row is repeated once per grouping set with the columns outside the set nulled,
+      # so all sets are aggregated in one pass and merged into one target keyed by grouping_id as well
+      self._cols = [F.when(F.col('__grouping_set').isin([i for i, gs in enumerate(self._groupingSets) if c in gs]), F.col(c)).alias(c) for c in cols]
+      self._cols.append(F.element_at(F.array(*[F.lit(GroupBy._groupingId(cols, gs)) for gs in self._groupingSets]), F.col('__grouping_set') + 1).cast('bigint').alias('grouping_id'))
+      self._keyNames = list(cols) + ['grouping_id']
+
+  @staticmethod
+  def _groupingId(cols, groupingSet):
+    # same bit order as Spark's grouping_id(), the first column is the most significant bit and set when the column is aggregated away
+    return sum([(1 << (len(cols) - 1 - i)) for i, c in enumerate(cols) if c not in groupingSet])
+
+  @staticmethod
+  def rollupSets(cols):
+    return [list(cols[:i]) for i in range(len(cols), -1, -1)]
+
+  @staticmethod
+  def cubeSets(cols):
+    return [[c for i, c in enumerate(cols) if mask & (1 << (len(cols) - 1 - i)) == 0] for mask in range(1 << len(cols))]
+
+  def prepare(self, df):
+    for w in self._windows:
+      df = w.prepare(df)
+    if self._groupingSets is not None:
+      df = df.withColumn('__grouping_set', F.explode(F.array(*[F.lit(i) for i in range(len(self._groupingSets))])))
+    return df
+
+  def paneColumns(self):
+    # Keys of the per slice partial aggregation of sliding windows. None where rows are fanned out to their windows
+    # directly, which is the case without sliding windows and for grouping sets or computed groupBy columns
+    if self._groupingSets is not None or not any(w.isSliding() for w in self._windows) or not all(isinstance(c, str) for c in self._plainCols):
+      return None
+    return self._plainCols + [w._sliceName() for w in self._windows]
+
+  def preparePanes(self, df):
+    for w in self._windows:
+      df = w.assignSlice(df)
+    return df
+
+  def fanOut(self, df):
+    for w in self._windows:
+      df = w.fanOut(df)
+    return df
+
+  def windows(self):
+    return self._windows
+
+  def groupingSets(self):
+    return self._groupingSets
+
+  def keyNames(self):
+    return self._keyNames
 
   def _chainStreamingQuery(self, dependentQuery, upstreamJoinCond):
     self._dependentQuery = dependentQuery
@@ -158,9 +867,290 @@ class GroupBy:
 
   def agg(self, *aggCols):
     return GroupByWithAggs(self, aggCols)._chainStreamingQuery(self._dependentQuery, self._upstreamJoinCond)
+
+  def topN(self, n, orderBy, ascending = False, reserve = None):
+    return GroupByTopN(self, n, orderBy, ascending, reserve)._chainStreamingQuery(self._dependentQuery, self._upstreamJoinCond)
   
   def stream(self):
     return self._stream
   
   def columns(self):
-    return self._cols
\ No newline at end of file
+    return self._cols
+class FusedGroupBy:
+  _aggs = None
+  _cols = None
+  _staged = None
+
+  def __init__(self, aggs, cols):
+    self._aggs = aggs
+    self._cols = cols
+
+  def _stagedGroupBy(self):
+    # everything but a fusable agg() works on the staged GroupBy, which is only created when first needed
+    if self._staged is None:
+      self._staged = self._aggs._stagedGroupBy(self._cols)
+    return self._staged
+
+  def agg(self, *aggCols):
+    fused = self._aggs._fuse(self._cols, aggCols)
+    if fused is not None:
+      return fused
+    return self._stagedGroupBy().agg(*aggCols)
+
+  def topN(self, n, orderBy, ascending = False, reserve = None):
+    return self._stagedGroupBy().topN(n, orderBy, ascending, reserve)
+
+  def prepare(self, df):
+    return self._stagedGroupBy().prepare(df)
+
+  def windows(self):
+    return self._stagedGroupBy().windows()
+
+  def groupingSets(self):
+    return self._stagedGroupBy().groupingSets()
+
+  def keyNames(self):
+    return self._stagedGroupBy().keyNames()
+
+  def stream(self):
+    return self._stagedGroupBy().stream()
+
+  def columns(self):
+    return self._stagedGroupBy().columns()
+
+class PreAggregatedJoin:
+  _aggs = None
+  _right = None
+  _joinType = None
+  _joinKeys = None
+  _stagingPath = None
+  _partitionColumns = None
+  _coalesceArgs = None
+
+  def __init__(self, aggs, right, joinType, joinKeys, stagingPath):
+    self._aggs = aggs
+    self._right = right
+    self._joinType = joinType
+    self._joinKeys = joinKeys
+    self._stagingPath = stagingPath
+
+  def reduce(self, column, update, delta_update = None, insert = None):
+    self._aggs.reduce(column, update, delta_update, insert)
+    return self
+
+  def partitionBy(self, *columns):
+    self._partitionColumns = columns
+    return self
+
+  def coalesceWrites(self, maxRows = None, maxBytes = None, maxLatencySecs = None, bufferPath = None):
+    self._coalesceArgs = (maxRows, maxBytes, maxLatencySecs, bufferPath)
+    return self
+
+  def _joined(self):
+    # the staged groups keep their hidden row count, the joined target deletes a group once its rows are all gone
+    streamJoin = self._aggs._join(self._right, self._joinType, self._stagingPath, countRows = True)
+    aggStream = streamJoin._left
+    joined = streamJoin.onKeys(*self._joinKeys).select(*[aggStream[c] for c in aggStream.columns()])
+    if '__rows' in aggStream.columns():
+      joined = joined._deleteWhenEmpty('__rows')
+    if self._partitionColumns is not None:
+      joined = joined.partitionBy(*self._partitionColumns)
+    if self._coalesceArgs is not None:
+      joined = joined.coalesceWrites(*self._coalesceArgs)
+    return joined
+
+  def explain(self):
+    return self._joined().explain()
+
+  def join(self, right, joinType = 'inner', stagingPath = None):
+    return self._joined().join(right, joinType, stagingPath)
+
+  def groupBy(self, *cols, stagingPath = None):
+    # the joined groups are staged and aggregated again, groups deleted from the staging table are retracted
+    return self._joined().groupBy(*cols, stagingPath = stagingPath)
+
+  def writeToPath(self, path):
+    return self._joined().writeToPath(path)
+
+  def writeToTable(self, tableName):
+    return self._joined().writeToTable(tableName)
+
+  def writeToKeyValue(self, kvPath, path = None, tableName = None):
+    return self._joined().writeToKeyValue(kvPath, path, tableName)
+
+class PreAggregatingGroupBy:
+  _join = None
+  _cols = None
+  _stagingPath = None
+
+  def __init__(self, join, cols, stagingPath):
+    self._join = join
+    self._cols = cols
+    self._stagingPath = stagingPath
+
+  def _leftOnly(self, aggCols):
+    left = self._join._left
+    try:
+      left.static().groupBy(*self._cols).agg(*[(ac if isinstance(ac, Column) else ac.toColumn()) for ac in aggCols]).schema
+      return True
+    except AnalysisException:
+      return False
+
+  def topN(self, n, orderBy, ascending = False, reserve = None):
+    # ranking keeps whole joined rows, so only agg() is computed ahead of the join
+    return self._join.select('*').groupBy(*self._cols, stagingPath = self._stagingPath).topN(n, orderBy, ascending, reserve)
+
+  def agg(self, *aggCols):
+    join = self._join
+    if not self._leftOnly(aggCols):
+      return join.select('*').groupBy(*self._cols, stagingPath = self._stagingPath).agg(*aggCols)
+    # Every group joins at most one right row as the join keys are among the groupBy columns and cover the right primary keys.
+    # Aggregating the left changes first and joining the groups gives the same rows as aggregating the joined rows
+    aggs = GroupBy(join._left, self._cols)._chainStreamingQuery(join._dependentQuery, join._upstreamJoinCond).agg(*aggCols)
+    return PreAggregatedJoin(aggs, join._right, join._joinType, join._joinKeys, self._stagingPath)
+
+class TopNOrder:
+  _orderBy = None
+  _rowColumns = None
+  _mapColumns = None
+  _ascending = None
+  _bufferSize = None
+
+  def __init__(self, orderBy, rowColumns, ascending, bufferSize, mapColumns = []):
+    self._orderBy = orderBy
+    self._rowColumns = rowColumns
+    self._mapColumns = mapColumns
+    self._ascending = ascending
+    self._bufferSize = bufferSize
+
+  def name(self):
+    return '__entry'
+
+  def isMin(self):
+    return self._ascending
+
+  def bufferSize(self):
+    return self._bufferSize
+
+  def valueColumn(self):
+    # ordering columns come first so entries sort by them, the whole row follows so a preimage retracts exactly the row it replaces
+    # maps can be neither sorted nor grouped by, so map columns are carried as their sorted entries
+    return F.struct(*[(F.col(c) if isinstance(c, str) else c).alias(f'__o{i}') for i, c in enumerate(self._orderBy)],
+                    F.struct(*[(F.array_sort(F.map_entries(c)) if c in self._mapColumns else F.col(c)).alias(c) for c in self._rowColumns]).alias('__row'))
+
+  def rowColumn(self, entry, c):
+    value = F.col(f'{entry}.__row.{c}')
+    return F.map_from_entries(value) if c in self._mapColumns else value
+
+class GroupByTopN:
+  _groupBy = None
+  _stream = None
+  _n = None
+  _orderBy = None
+  _ascending = None
+  _reserve = None
+  _dependentQuery = None
+  _upstreamJoinCond = None
+
+  def __init__(self, groupBy, n, orderBy, ascending = False, reserve = None):
+    self._groupBy = groupBy
+    self._stream = groupBy.stream()
+    self._n = n
+    self._orderBy = orderBy if isinstance(orderBy, (list, tuple)) else [orderBy]
+    self._ascending = ascending
+    self._reserve = n if reserve is None else reserve
+
+  def _chainStreamingQuery(self, dependentQuery, upstreamJoinCond):
+    self._dependentQuery = dependentQuery
+    self._upstreamJoinCond = upstreamJoinCond
+    return self
+
+  def _doMerge(self, deltaTable, state, order, keyCols, rowCols, batchDf, batchId):
+    batchKeys = self._groupBy.prepare(batchDf).select(*self._groupBy.columns()).distinct()
+    newState = state.update(batchDf, batchKeys, batchId)
+    # Every touched group gets a row for each of the n ranks, ranks the group no longer fills are deleted from the target.
+    # Ranks are positions in the sorted entries expanded by their counts, like row_number: rows tied on the order columns
+    # and repeated rows each take a rank of their own, no entry is expanded beyond n
+    ranked = (
+      newState.select(*keyCols, F.expr(f'slice(flatten(transform(__values, e -> array_repeat(e.__value, least(CAST(e.__count AS int), {self._n})))), 1, {self._n})').alias('__ranked'))
+              .select(*keyCols, '__ranked', F.explode(F.sequence(F.lit(1), F.lit(self._n))).alias('__rank'))
+              .select(*keyCols, '__rank', F.expr('try_element_at(__ranked, __rank)').alias('__entry'))
+              .select(*keyCols, '__rank', *[order.rowColumn('__entry', c).alias(c) for c in rowCols], F.col('__entry').isNull().alias('__empty'))
+    )
+    cond = ' AND '.join([f'u.{k} <=> staged_updates.{k}' for k in keyCols + ['__rank']])
+    values = {c: F.col(f'staged_updates.{c}') for c in keyCols + ['__rank'] + rowCols}
+    (
+      deltaTable.alias('u').merge(ranked.alias('staged_updates'), F.expr(cond))
+                .whenMatchedDelete(condition = 'staged_updates.__empty')
+                .whenMatchedUpdate(set = {c: F.col(f'staged_updates.{c}') for c in rowCols})
+                .whenNotMatchedInsert(condition = 'NOT staged_updates.__empty', values = values)
+                .execute()
+    )
+    state.cleanup()
+
+  def _writeToTarget(self, deltaTableForFunc, tableName, path, keyValueSink = None):
+    from elzyme.streams import DataStreamWriter
+    staticDf = self._groupBy.prepare(self._stream.static())
+    keyCols = self._groupBy.keyNames()
+    rowCols = [c for c in self._stream.columns() if c not in keyCols]
+    mapCols = [f.name for f in staticDf.schema.fields if f.name in rowCols and isinstance(f.dataType, MapType)]
+    order = TopNOrder(self._orderBy, self._stream.columns(), self._ascending, self._n + self._reserve, mapCols)
+    schemaDf = staticDf.select(*self._groupBy.columns(), F.lit(1).alias('__rank'), *rowCols)
+    createSql = f'CREATE TABLE IF NOT EXISTS {tableName}({schemaDf.schema.toDDL()}) USING DELTA TBLPROPERTIES (delta.enableChangeDataFeed = true, delta.autoOptimize.autoCompact = true, delta.autoOptimize.optimizeWrite = true)'
+    if path is not None:
+      createSql = f"{createSql} LOCATION '{path}'"
+    spark.sql(createSql)
+    location = deltaTableForFunc().detail().select('location').collect()[0][0]
+    mergeTransaction = MergeTransaction(tableName)
+    valueType = staticDf.select(order.valueColumn().alias('v')).schema['v'].dataType
+    state = (
+      MinMaxState(order, keyCols, self._groupBy, f'{os.path.dirname(location)}/$$_topn_{os.path.basename(location)}', self._stream, mergeTransaction, self._n)
+        .create(schemaDf.schema.fields[:len(keyCols)], valueType)
+    )
+    def mergeFunc(batchDf, batchId):
+      batchDf._jdf.sparkSession().conf().set('spark.databricks.optimizer.adaptive.enabled', True)
+      batchDf._jdf.sparkSession().conf().set('spark.sql.adaptive.forceApply', True)
+      deltaTable = deltaTableForFunc(batchDf.sparkSession)
+      if not mergeTransaction.isCommitted(deltaTable, batchId):
+        with elzyme.metrics.phase('merge', batch=batchDf):
+          mergeTransaction.run(batchDf, batchId, lambda: self._doMerge(deltaTable, state, order, keyCols, rowCols, batchDf, batchId))
+        elzyme.metrics.countMerge(deltaTable, mergeTransaction, batchId)
+      if keyValueSink is not None:
+        # each rank of a group is its own key, ranks a group no longer fills are deleted from the store
+        keyValueSink.apply(deltaTable, tableName, keyCols + ['__rank'], batchId, mergeTransaction)
+    stageGate = StageGate(mergeFunc)
+    return DataStreamWriter(
+      (
+        self._stream.stream().writeStream.foreachBatch(stageGate)
+      )
+    )._chainStreamingQuery(self._dependentQuery, self._upstreamJoinCond)._addMergeTransaction(mergeTransaction)._addStageGate(stageGate)._setExplain(lambda: self._explainStage(tableName))
+
+  def _explainStage(self, tableName):
+    keyCols = self._groupBy.keyNames()
+    lines = [f"top {self._n} of {self._stream.name()} by {keyCols} into {tableName if tableName is not None else '(no target yet)'}",
+             f'input {self._stream.name()}: {self._stream.sizeEstimate()}',
+             f"order: {', '.join([str(c) for c in self._orderBy])} {'ascending' if self._ascending else 'descending'}",
+             'merge condition: ' + ' AND '.join([f'u.{k} <=> staged_updates.{k}' for k in keyCols + ['__rank']])]
+    for w in self._groupBy.windows():
+      lines.append(f'window {w.name()}: {w._windowSecs}s every {w._slideSecs}s')
+    if self._groupBy.groupingSets() is not None:
+      lines.append(f'grouping sets: {self._groupBy.groupingSets()}')
+    lines.append(f'state: {self._n + self._reserve} ranked rows per group, refilled from the source snapshot when fewer than {self._n} remain')
+    return lines
+
+  def explain(self):
+    stages = self._dependentQuery._explainStages() if self._dependentQuery is not None else []
+    print(elzyme.utils.formatStages(stages + [self._explainStage(None)]))
+
+  def writeToPath(self, path):
+    return self._writeToTarget(lambda session = spark: DeltaTable.forPath(session, path), f'delta.`{path}`', path)
+
+  def writeToTable(self, tableName):
+    return self._writeToTarget(lambda session = spark: DeltaTable.forName(session, tableName), tableName, None)
+
+  def writeToKeyValue(self, kvPath, path = None, tableName = None):
+    if path is not None:
+      return self._writeToTarget(lambda session = spark: DeltaTable.forPath(session, path), f'delta.`{path}`', path, KeyValueSink(kvPath))
+    if tableName is not None:
+      return self._writeToTarget(lambda session = spark: DeltaTable.forName(session, tableName), tableName, None, KeyValueSink(kvPath))
+    raise Exception('Either path or tableName of the Delta target backing the key-value store must be specified')
@@ -0,0 +1,166 @@
+from databricks.sdk.runtime import *
+from pyspark.sql import functions as F
+from delta.tables import *
+from pyspark import StorageLevel
+import threading
+import time
+
+class WriteCoalescer:
+  _bufferPath = None
+  _mergeTransaction = None
+  _mergeFunc = None
+  _maxRows = None
+  _maxBytes = None
+  _maxLatencySecs = None
+  _lock = None
+  _initialized = False
+  _rows = 0
+  _firstBufferedAt = None
+  _lastBatchId = None
+  _timer = None
+  _error = None
+  _session = None
+  _bytesPerRow = None
+
+  def __init__(self,
+               bufferPath,
+               mergeTransaction,
+               mergeFunc,
+               maxRows = None,
+               maxBytes = None,
+               maxLatencySecs = None):
+    if maxRows is None and maxBytes is None and maxLatencySecs is None:
+      raise Exception('At least one of maxRows, maxBytes or maxLatencySecs must be specified to coalesce writes')
+    self._bufferPath = bufferPath
+    self._mergeTransaction = mergeTransaction
+    self._mergeFunc = mergeFunc
+    self._maxRows = maxRows
+    self._maxBytes = maxBytes
+    self._maxLatencySecs = maxLatencySecs
+    self._lock = threading.Lock()
+
+  def bufferPath(self):
+    return self._bufferPath
+
+  def _loadState(self):
+    # Buffered rows survive restarts so rebuild the counters from the buffer table itself
+    self._rows = 0
+    self._firstBufferedAt = None
+    self._lastBatchId = None
+    if DeltaTable.isDeltaTable(spark, self._bufferPath):
+      row = spark.read.format('delta').load(self._bufferPath).agg(F.count(F.lit(1)), F.min('__buffered_at'), F.max('__batch_id')).collect()[0]
+      self._rows = row[0]
+      self._firstBufferedAt = row[1]
+      self._lastBatchId = row[2]
+    self._initialized = True
+
+  def _append(self, batchDf, batchId):
+    # txnAppId/txnVersion make the append idempotent so a replayed batch is not buffered twice. The appId carries the
+    # query id like the target's MERGE tags do, without it an append after a checkpoint reset is not deduplicated at all
+    writer = (
+      batchDf.withColumn('__batch_id', F.lit(batchId))
+             .withColumn('__buffered_at', F.lit(time.time()))
+             .write.format('delta')
+             .mode('append')
+    )
+    appId = self._mergeTransaction.appId()
+    if appId is not None:
+      writer = writer.option('txnAppId', appId).option('txnVersion', batchId)
+    writer.save(self._bufferPath)
+
+  def _bufferedBytes(self):
+    return DeltaTable.forPath(spark, self._bufferPath).detail().select('sizeInBytes').collect()[0][0]
+
+  def _bytesReached(self):
+    # The buffer size is estimated from the row count, DESCRIBE DETAIL only runs to learn the size of a row
+    # and to confirm the estimate once it reaches maxBytes
+    if self._bytesPerRow is not None and self._rows * self._bytesPerRow < self._maxBytes:
+      return False
+    bufferedBytes = self._bufferedBytes()
+    self._bytesPerRow = bufferedBytes / self._rows
+    return bufferedBytes >= self._maxBytes
+
+  def _shouldFlush(self):
+    if self._rows == 0:
+      return False
+    if self._maxRows is not None and self._rows >= self._maxRows:
+      return True
+    if self._maxLatencySecs is not None and time.time() - self._firstBufferedAt >= self._maxLatencySecs:
+      return True
+    if self._maxBytes is not None and self._bytesReached():
+      return True
+    return False
+
+  def _flushSession(self):
+    # Flushes outside a microbatch merge through a session of their own. The merge sets its commit tags as session
+    # confs, which must not leak into queries running concurrently on the shared session
+    if self._session is None:
+      self._session = spark.newSession()
+    return self._session
+
+  def _flush(self, session):
+    bufferDf = session.read.format('delta').load(self._bufferPath).where(F.col('__batch_id') <= F.lit(self._lastBatchId)).persist(StorageLevel.MEMORY_AND_DISK)
+    try:
+      self._mergeFunc(bufferDf, self._lastBatchId)
+    finally:
+      bufferDf.unpersist()
+    # If we fail before the delete the buffered rows are merged again on restart, which is safe since join merges are upserts
+    DeltaTable.forPath(session, self._bufferPath).delete(F.col('__batch_id') <= F.lit(self._lastBatchId))
+    self._rows = 0
+    self._firstBufferedAt = None
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+
+  def _scheduleFlush(self):
+    # maxLatencySecs holds even when no further batch arrives, a timer flushes the buffer once its oldest row is due
+    if self._maxLatencySecs is None or self._timer is not None or self._firstBufferedAt is None:
+      return
+    self._timer = threading.Timer(max(0, self._firstBufferedAt + self._maxLatencySecs - time.time()), self._flushDue)
+    self._timer.daemon = True
+    self._timer.start()
+
+  def _flushDue(self):
+    with self._lock:
+      self._timer = None
+      try:
+        if self._shouldFlush():
+          self._flush(self._flushSession())
+      except Exception as e:
+        # surfaced by the next add() or flush() rather than lost on the timer thread
+        self._error = e
+        return
+      self._scheduleFlush()
+
+  def _raiseError(self):
+    if self._error is not None:
+      error = self._error
+      self._error = None
+      raise Exception(f'Flushing coalesced writes buffered in {self._bufferPath} failed') from error
+
+  def add(self, batchDf, batchId):
+    with self._lock:
+      self._raiseError()
+      rows = batchDf.count()
+      if rows > 0:
+        self._append(batchDf, batchId)
+      if not self._initialized:
+        self._loadState()
+      elif rows > 0:
+        self._rows += rows
+        self._lastBatchId = batchId
+        if self._firstBufferedAt is None:
+          self._firstBufferedAt = time.time()
+      if self._shouldFlush():
+        self._flush(batchDf.sparkSession)
+      self._scheduleFlush()
+
+  def flush(self):
+    with self._lock:
+      self._raiseError()
+      if not self._initialized:
+        self._loadState()
+      if self._rows == 0:
+        return False
+      self._flush(self._flushSession())
+      return True
\ No newline at end of file
@@ -3,12 +3,19 @@ from databricks.sdk.runtime import *
 from delta.tables import *
 from pyspark.sql import functions as F
 from pyspark.sql.window import Window
+from pyspark.sql.types import MapType
 import uuid
 from pyspark import StorageLevel
 import os
 import hashlib
 import itertools
 import elzyme.utils
+import elzyme.metrics
+from elzyme.coalesce import WriteCoalescer
+from elzyme.kv import KeyValueSink
+from elzyme.txn import MergeTransaction
+from elzyme.scheduler import StageGate
+from elzyme.staging import StagingRegistry
 
 class StreamToStreamJoin:
   _left = None
@@ -65,7 +72,9 @@ class StreamToStreamJoin:
     return StreamToStreamJoinWithCondition(self._left,
                self._right,
                self._joinType,
-               joinExpr)._chainStreamingQuery(self._dependentQuery, self._upstreamJoinCond).to(func)
+               joinExpr,
+               func,
+               joinKeys = keys)._chainStreamingQuery(self._dependentQuery, self._upstreamJoinCond)
 
 class Expression:
   _left = None
@@ -255,12 +264,16 @@ class StreamingJoin:
       nonlocal lastRightMaxCommitVersion
       left = batchDf.where("left is not null AND left._change_type != 'update_preimage'").select('left.*')
       right = batchDf.where("right is not null AND right._change_type != 'update_preimage'").select('right.*')
-      maxCommitVersions = (
-                                left.agg(F.max('_commit_version').alias('_left_commit_version'), F.lit(None).alias('_right_commit_version'))
-                                    .unionByName(right.agg(F.lit(None).alias('_left_commit_version'), F.max('_commit_version').alias('_right_commit_version')))
-                                    .agg(F.sum('_left_commit_version').alias('_left_commit_version'), F.sum('_right_commit_version').alias('_right_commit_version'))
-                                    .collect()[0]
-                             )
+      with elzyme.metrics.phase('versionProbe', batch=batchDf):
+        # the row counts per side come with the same job that finds the max commit versions
+        maxCommitVersions = (
+                                  left.agg(F.max('_commit_version').alias('_left_commit_version'), F.lit(None).alias('_right_commit_version'), F.count(F.lit(1)).alias('_left_rows'), F.lit(None).alias('_right_rows'))
+                                      .unionByName(right.agg(F.lit(None).alias('_left_commit_version'), F.max('_commit_version').alias('_right_commit_version'), F.lit(None).alias('_left_rows'), F.count(F.lit(1)).alias('_right_rows')))
+                                      .agg(F.sum('_left_commit_version').alias('_left_commit_version'), F.sum('_right_commit_version').alias('_right_commit_version'), F.sum('_left_rows'), F.sum('_right_rows'))
+                                      .collect()[0]
+                               )
+      elzyme.metrics.count('leftRows', maxCommitVersions[2])
+      elzyme.metrics.count('rightRows', maxCommitVersions[3])
       # We want to grab the max commit version in the microbatch so we do a consistent read of left and right static pinned at that version
       # otherwise the read may be non-deterministic due to lazy spark evaluation
       leftMaxCommitVersion = maxCommitVersions[0]
@@ -281,13 +294,23 @@ class StreamingJoin:
         rightStaticLocal = self._right.static(rightMaxCommitVersion)
       lastLeftMaxCommitVersion = leftMaxCommitVersion
       lastRightMaxCommitVersion = rightMaxCommitVersion
+      if elzyme.metrics.enabled():
+        elzyme.metrics.count('leftSnapshotVersion', leftMaxCommitVersion)
+        elzyme.metrics.count('rightSnapshotVersion', rightMaxCommitVersion)
+        # the size of each static table bounds the bytes its snapshot read can scan
+        elzyme.metrics.count('leftSnapshotBytes', self._left.sizeInBytes())
+        elzyme.metrics.count('rightSnapshotBytes', self._right.sizeInBytes())
       with MicrobatchJoin(left, leftStaticLocal, right, rightStaticLocal) as mj:
-        joinedBatchDf = mj.join(self._joinType,
-                                joinExpr,
-                                self._primaryKeys,
-                                transformFunc,
-                                selectCols,
-                                finalSelectCols)
+        with elzyme.metrics.phase('join', left=left, leftStatic=leftStaticLocal, right=right, rightStatic=rightStaticLocal) as p:
+          joinedBatchDf = p.output('joined', mj.join(self._joinType,
+                                                     joinExpr,
+                                                     self._primaryKeys,
+                                                     transformFunc,
+                                                     selectCols,
+                                                     finalSelectCols))
+          if elzyme.metrics.enabled():
+            # the joined batch is persisted, counting it only fills the cache the merge reads anyway
+            elzyme.metrics.count('joinedRows', joinedBatchDf.count())
         return mergeFunc(joinedBatchDf, batchId)
     return _mergeJoin
 
@@ -298,12 +321,13 @@ class StreamingJoin:
            finalSelectCols):
     from elzyme.streams import DataStreamWriter
     packed = self._left.stream().select(F.struct('*').alias('left'), F.lit(None).alias('right')).unionByName(self._right.stream().select(F.lit(None).alias('left'), F.struct('*').alias('right')))
+    stageGate = StageGate(self._merge(joinExpr, transformFunc, selectCols, finalSelectCols))
     return DataStreamWriter(
       (packed
         .writeStream 
-        .foreachBatch(self._merge(joinExpr, transformFunc, selectCols, finalSelectCols))
+        .foreachBatch(stageGate)
       )
-    )._chainStreamingQuery(self._dependentQuery, self._upstreamJoinCond)
+    )._chainStreamingQuery(self._dependentQuery, self._upstreamJoinCond)._addStageGate(stageGate)
 
 class StreamToStreamJoinWithConditionForEachBatch:
   _left = None
@@ -316,6 +340,9 @@ class StreamToStreamJoinWithConditionForEachBatch:
   _finalSelectCols = None
   _dependentQuery = None
   _upstreamJoinCond = None
+  _coalesceOptions = None
+  _coalesceBufferPath = None
+  _rowCountColumn = None
 
   def __init__(self,
                left,
@@ -356,15 +383,34 @@ class StreamToStreamJoinWithConditionForEachBatch:
     self._partitionColumns = [(c if isinstance(c, PartitionColumn) else PartitionColumn(c)) for c in columns]
     return self
 
+  def _deleteWhenEmpty(self, rowCountColumn):
+    # the selected column counts the rows behind each joined row, rows whose count dropped to zero are deleted
+    # from the target instead of updated and the column itself is not written
+    self._rowCountColumn = rowCountColumn
+    return self
+
+  def coalesceWrites(self, maxRows = None, maxBytes = None, maxLatencySecs = None, bufferPath = None):
+    self._coalesceOptions = {'maxRows': maxRows, 'maxBytes': maxBytes, 'maxLatencySecs': maxLatencySecs}
+    self._coalesceBufferPath = bufferPath
+    return self
+
+  def _createCoalescer(self, tableName, path, mergeTransaction, mergeFunc):
+    bufferPath = self._coalesceBufferPath
+    if bufferPath is None:
+      if path is None:
+        raise Exception(f'bufferPath must be specified to coalesce writes to table {tableName}')
+      bufferPath = f'{os.path.dirname(path)}/$$_coalesce_{os.path.basename(path)}'
+    return WriteCoalescer(bufferPath, mergeTransaction, mergeFunc, **self._coalesceOptions)
+
   def foreachBatch(self, mergeFunc):
-    windowSpec = None
+    dedupOrder = None
     primaryKeys = self._safeMergeLists(self._left.getPrimaryKeys(), self._right.getPrimaryKeys())
     sequenceColumns = self._safeMergeLists(self._left.getSequenceColumns(), self._right.getSequenceColumns())
     if primaryKeys is not None and len(primaryKeys) > 0 and sequenceColumns is not None and len(sequenceColumns) > 0:
-      windowSpec = Window.partitionBy(primaryKeys).orderBy([F.desc(sc) for sc in sequenceColumns])
+      dedupOrder = [F.col(sc) for sc in sequenceColumns]
     def mergeTransformFunc(batchDf, batchId):
       batchDf = batchDf.where("_change_type != 'update_preimage'")
-      return mergeFunc(self._dedupBatch(batchDf, windowSpec, primaryKeys), batchId)
+      return mergeFunc(self._dedupBatch(batchDf, dedupOrder, primaryKeys), batchId)
     return StreamingJoin(self._left,
                self._right,
                self._joinType,
@@ -373,22 +419,44 @@ class StreamToStreamJoinWithConditionForEachBatch:
                                self._selectCols,
                                self._finalSelectCols)._chainStreamingQuery(self._dependentQuery, self._upstreamJoinCond)
 
-  def _dedupBatch(self, batchDf, windowSpec, primaryKeys):
-    if windowSpec is not None:
-      batchDf = batchDf.withColumn('__row_number', F.row_number().over(windowSpec)).where('__row_number = 1')
+  def _dedupBatch(self, batchDf, dedupOrder, primaryKeys):
+    # Keeps the row with the greatest dedupOrder per primary key with a hash aggregation rather than
+    # a row_number() window, which would sort the whole batch within every partition
+    if dedupOrder is not None:
+      columns = batchDf.columns
+      batchDf = (
+        batchDf.groupBy(*primaryKeys)
+               .agg(F.max_by(F.struct(*[c for c in columns if c not in primaryKeys]), F.struct(*dedupOrder)).alias('__row'))
+               .select(*primaryKeys, '__row.*')
+               .select(*columns)
+      )
     else:
       batchDf = batchDf.dropDuplicates(primaryKeys)
     return batchDf
 
-  def _doMerge(self, deltaTable, cond, primaryKeys, sequenceWindowSpec, updateCols, matchCondition, batchDf, batchId):
+  def _doMerge(self, deltaTable, cond, primaryKeys, updateCols, updateClauses, deleteCondition, batchDf, batchId):
 #    print(f'****** {cond} ******')
     mergeChain = deltaTable.alias("u").merge(
         source = batchDf.alias("staged_updates"),
         condition = F.expr(cond))
-    mergeChain.whenMatchedUpdate(condition = matchCondition, set = updateCols) \
-        .whenNotMatchedInsert(values = updateCols) \
+    if deleteCondition is not None:
+      mergeChain = mergeChain.whenMatchedDelete(condition = deleteCondition)
+    for updateCondition, updateSet in updateClauses:
+      mergeChain = mergeChain.whenMatchedUpdate(condition = updateCondition, set = updateSet)
+    mergeChain.whenNotMatchedInsert(condition = f'NOT ({deleteCondition})' if deleteCondition is not None else None, values = updateCols) \
         .execute()
 
+  def _changedCondition(self, field, stagedPrefix):
+    # maps are not comparable, so map columns (like the sketches of percentile aggregates) are compared by their sorted entries
+    if isinstance(field.dataType, MapType):
+      return f'NOT (array_sort(map_entries(u.{field.name})) <=> array_sort(map_entries(staged_updates.{stagedPrefix}{field.name})))'
+    return f'NOT (u.{field.name} <=> staged_updates.{stagedPrefix}{field.name})'
+
+  def _updateClauses(self, deltaTableFields, updateCols, matchCondition, stagedPrefix):
+    # Matched rows are only rewritten when a column actually changed, so unchanged rows add nothing to the target's CDF
+    changed = ' OR '.join([self._changedCondition(f, stagedPrefix) for f in deltaTableFields])
+    return [(changed if matchCondition is None else f'({matchCondition}) AND ({changed})', updateCols)]
+
   def _mergeCondition(self, nonNullableKeys, nullableKeys, extraCond = ''):
     arr = []
     for i in range(0, len(nullableKeys)+1):
@@ -424,29 +492,38 @@ class StreamToStreamJoinWithConditionForEachBatch:
     elif joinType == 'right':
       return list(dict.fromkeys([pk for pk in nullKeys if pk not in nonNullKeys] + [pk for pk in nullCandidateKeys if pk not in nullKeys]))
 
+  def _mergeKeys(self):
+    # non-nullable and nullable merge keys of the target combine the keys inherited from upstream joins with this join's keys
+    primaryKeys = self._safeMergeLists(self._left.getPrimaryKeys(), self._right.getPrimaryKeys())
+    sequenceColumns = self._safeMergeLists(self._left.getSequenceColumns(), self._right.getSequenceColumns())
+    pks = [[], []]
+    if self._upstreamJoinCond is not None:
+      pks = self._upstreamJoinCond()
+    pks1 = self._nonNullAndNullPrimaryKeys(self._joinType,
+                                           [pk for pk in primaryKeys if pk in self._left.getPrimaryKeys()],
+                                           [pk for pk in primaryKeys if pk in self._right.getPrimaryKeys()])
+    pks = [self._mergeNonNullKeysForJoin(self._joinType, pks[0], pks[1], pks1[0], pks1[1]), self._mergeNullKeysForJoin(self._joinType, pks[0], pks[1], pks1[0], pks1[1])]
+    condInitial = ' AND '.join([f'u.{pk} = staged_updates.{pk}' for pk in pks[0]] + [f'u.{pk} <=> staged_updates.{pk}' for pk in pks[1]])
+    return primaryKeys, sequenceColumns, pks, condInitial
+
   def _buildPrunedPartitionColumnFunc(self, prunedPartitionColumns, partitionColumnsExpr, hasNullableKeys):
     partitionColumnsExprFunc = None
     if len(prunedPartitionColumns) > 0:
       def pruneFunc(batchDf):
-        colValues = [batchDf.select(pc.column()).distinct().collect() for pc in prunedPartitionColumns]
-        colValues = [[f"'{v[0]}'" if isinstance(v[0], str) else str(v[0]) if v[0] is not None else 'null' for v in vals] for vals in colValues]
-        pcAndVals = [(pc, vals) for pc, vals in zip(prunedPartitionColumns, colValues)]
-        expr = ' AND '.join([f"(u.{pc[0].column()} in ({','.join(pc[1])})" + (f' OR u.{pc[0].column()} is null' if hasNullableKeys else '') + ')' for pc in pcAndVals if len(pc[1]) > 0])
-        return expr
-      if partitionColumnsExpr is not None and len(partitionColumnsExpr) > 0:
-        partitionColumnsExprFunc = lambda batchDf: f'{partitionColumnsExpr} AND {pruneFunc(batchDf)}'
-      else:
-        partitionColumnsExprFunc = pruneFunc
+        exprs = [partitionColumnsExpr, elzyme.utils.partitionPruneCondition(batchDf, prunedPartitionColumns, hasNullableKeys)]
+        return ' AND '.join([e for e in exprs if e is not None and len(e) > 0])
+      partitionColumnsExprFunc = pruneFunc
     return partitionColumnsExprFunc
 
-  def _writeToTarget(self, deltaTableForFunc, tableName, path):
+  def _writeToTarget(self, deltaTableForFunc, tableName, path, keyValueSink = None):
     leftStatic = self._left.static()
     rightStatic = self._right.static()
     schemaDf = leftStatic.join(rightStatic,
                                                    self._joinExpr(leftStatic, rightStatic))
     if self._transformFunc is not None:
       schemaDf = self._transformFunc(schemaDf, leftStatic, rightStatic)
-    schemaDf = schemaDf.select(self._finalSelectCols(leftStatic, rightStatic))
+    hiddenColumns = [self._rowCountColumn] if self._rowCountColumn is not None else []
+    schemaDf = schemaDf.select(self._finalSelectCols(leftStatic, rightStatic)).drop(*hiddenColumns)
     ddl = schemaDf.schema.toDDL()
     createSql = f'CREATE TABLE IF NOT EXISTS {tableName}({ddl}) USING DELTA TBLPROPERTIES (delta.enableChangeDataFeed = true, delta.autoOptimize.autoCompact = true, delta.autoOptimize.optimizeWrite = true)'
     if path is not None:
@@ -455,23 +532,7 @@ class StreamToStreamJoinWithConditionForEachBatch:
       createSql = f"{createSql} PARTITIONED BY ({', '.join([pc.column() for pc in self._partitionColumns])})"
     spark.sql(createSql)
 
-    primaryKeys = self._safeMergeLists(self._left.getPrimaryKeys(), self._right.getPrimaryKeys())
-    sequenceColumns = self._safeMergeLists(self._left.getSequenceColumns(), self._right.getSequenceColumns())
-    pks = [[], []]
-    if self._upstreamJoinCond is not None:
-      pks = self._upstreamJoinCond()
-#       print(f'%%%%%%%%%% nonNullKeys = {pks[0]}')
-#       print(f'%%%%%%%%%% nullKeys = {pks[1]}')
-    pks1 = self._nonNullAndNullPrimaryKeys(self._joinType,
-                                           [pk for pk in primaryKeys if pk in self._left.getPrimaryKeys()],
-                                           [pk for pk in primaryKeys if pk in self._right.getPrimaryKeys()])
-#     print(f'%%%%%%%%%% self._joinType = {self._joinType}')
-#     print(f'%%%%%%%%%% nonNullCandidateKeys = {pks1[0]}')
-#     print(f'%%%%%%%%%% nullCandidateKeys = {pks1[1]}')
-    pks = [self._mergeNonNullKeysForJoin(self._joinType, pks[0], pks[1], pks1[0], pks1[1]), self._mergeNullKeysForJoin(self._joinType, pks[0], pks[1], pks1[0], pks1[1])]
-#     print(f'%%%%%%%%%% pks[0] = {pks[0]}')
-#     print(f'%%%%%%%%%% pks[1] = {pks[1]}')
-    condInitial = ' AND '.join([f'u.{pk} = staged_updates.{pk}' for pk in pks[0]] + [f'u.{pk} <=> staged_updates.{pk}' for pk in pks[1]])
+    primaryKeys, sequenceColumns, pks, condInitial = self._mergeKeys()
     partitionColumns = []
     prunedPartitionColumns = []
     partitionColumnsExprFunc = None
@@ -488,7 +549,8 @@ class StreamToStreamJoinWithConditionForEachBatch:
     matchCondition = None
     insertFilter = None
     updateFilter = None
-    deltaTableColumns = deltaTableForFunc().toDF().columns
+    deltaTableFields = deltaTableForFunc().toDF().schema.fields
+    deltaTableColumns = [f.name for f in deltaTableFields]
     if len(pks[1]) > 0:
       outerCondStr = self._mergeCondition(pks[0], pks[1])
       if len(partitionColumns) > 0 and len(prunedPartitionColumns) == 0:
@@ -501,23 +563,37 @@ class StreamToStreamJoinWithConditionForEachBatch:
       updateCols = {c: F.col(f'staged_updates.__u_{c}') for c in deltaTableColumns}
     else:
       updateCols = {c: F.col(f'staged_updates.{c}') for c in deltaTableColumns}
-    windowSpec = None
+    dedupOrder = None
+    # the winning row per primary key has the latest sequence and then the fewest null columns
+    fewestNulls = -F.expr('(' + ' + '.join([f'CASE WHEN {c} is not null THEN 0 ELSE 1 END' for c in deltaTableColumns]) + ')')
     if sequenceColumns is not None and len(sequenceColumns) > 0:
-      windowSpec = Window.partitionBy(primaryKeys).orderBy([F.desc(sc) for sc in sequenceColumns] + [F.expr('(' + ' + '.join([f'CASE WHEN {c} is not null THEN 0 ELSE 1 END' for c in deltaTableColumns]) + ')')])
+      dedupOrder = [F.col(sc) for sc in sequenceColumns] + [fewestNulls]
+      # coalesced batches are ordered by batch as well so a later batch wins over an earlier one on sequence ties
+      coalesceDedupOrder = [F.col(sc) for sc in sequenceColumns] + [F.col('__batch_id'), fewestNulls]
       matchCondition = ' AND '.join([f'(u.{sc} is null OR u.{sc} <= staged_updates.{"__u_" if len(pks[1]) > 0 else ""}{sc})' for sc in sequenceColumns])
     else:
-      windowSpec = Window.partitionBy(primaryKeys).orderBy([F.expr('(' + ' + '.join([f'CASE WHEN {c} is not null THEN 0 ELSE 1 END' for c in deltaTableColumns]) + ')')])
+      dedupOrder = [fewestNulls]
+      coalesceDedupOrder = [F.col('__batch_id'), fewestNulls]
+    updateClauses = self._updateClauses(deltaTableFields, updateCols, matchCondition, '__u_' if len(pks[1]) > 0 else '')
+    deleteCondition = None
+    if self._rowCountColumn is not None:
+      deleteCondition = f"staged_updates.{'__u_' if len(pks[1]) > 0 else ''}{self._rowCountColumn} <= 0"
     if outerCondInitial is not None:
       targetMergeKeyColumns = self._safeMergeLists(primaryKeys, [pc.column() for pc in partitionColumns])
-      batchSelect = [F.col(f'staged_updates.{c}').alias(f'__u_{c}') for c in deltaTableColumns] + [F.expr(f'CASE WHEN __operation_flag = 2 THEN staged_updates.{c} WHEN __operation_flag = 1 THEN u.{c} END AS {c}') for c in targetMergeKeyColumns] + [F.when(F.expr('__operation_flag = 1'), F.row_number().over(outerWindowSpec)).otherwise(F.lit(2)).alias('__rn')]
+      batchSelect = [F.col(f'staged_updates.{c}').alias(f'__u_{c}') for c in deltaTableColumns + hiddenColumns] + [F.expr(f'CASE WHEN __operation_flag = 2 THEN staged_updates.{c} WHEN __operation_flag = 1 THEN u.{c} END AS {c}') for c in targetMergeKeyColumns] + [F.when(F.expr('__operation_flag = 1'), F.row_number().over(outerWindowSpec)).otherwise(F.lit(2)).alias('__rn')]
       operationFlag = F.expr(f'CASE WHEN {updateFilter} THEN 1 WHEN {insertFilter} THEN 2 END').alias('__operation_flag')
       nullsCol = F.expr(' + '.join([f'CASE WHEN {pk} is not null THEN 0 ELSE 1 END' for pk in pks[1]]))
       stagedNullsCol = F.expr(' + '.join([f'CASE WHEN __u_{pk} is not null THEN 0 ELSE 1 END' for pk in pks[1]]))
       antiJoinCond = F.expr(' AND '.join([f'({outerCondStr})', '((u.__rn != 1 AND (u.__pk_nulls_count > staged_updates.__pk_nulls_count OR u.__u_pk_nulls_count > staged_updates.__u_pk_nulls_count)))', ' AND '.join([f'(u.__u_{pk} <=> staged_updates.__u_{pk} OR u.__u_{pk} is null)' for pk in pks[1]])]))
-    def mergeFunc(batchDf, batchId):
-      deltaTable = deltaTableForFunc()
+    mergeTransaction = MergeTransaction(tableName)
+    def mergeDedupedBatch(deltaTable, batchDf, batchId, batchDedupOrder):
       mergeDf = None
-      batchDf = self._dedupBatch(batchDf, windowSpec, primaryKeys)
+      dedupedDf = None
+      with elzyme.metrics.phase('dedup', batch=batchDf) as p:
+        batchDf = p.output('deduped', self._dedupBatch(batchDf, batchDedupOrder, primaryKeys))
+        if elzyme.metrics.enabled():
+          dedupedDf = batchDf = batchDf.persist(StorageLevel.MEMORY_AND_DISK)
+          elzyme.metrics.count('dedupedRows', batchDf.count())
       cond = condInitial
       if len(prunedPartitionColumns) > 0:
         partitionFilter = partitionColumnsExprFunc(batchDf)
@@ -530,29 +606,80 @@ class StreamToStreamJoinWithConditionForEachBatch:
             outerCond = F.expr(partitionFilter) & outerCond
 #         if 'product_id' in deltaTableColumns:
 #           batchDf.withColumnRenamed('_commit_version', '__commit_version').write.format('delta').mode('overwrite').save('/Users/leon.eller@databricks.com/tmp/error/batch0')
-        targetDf = deltaTable.toDF()
-        u = targetDf.alias('u')
-        su = F.broadcast(batchDf).alias('staged_updates')
-        mergeDf = u.join(su, outerCond, 'right').select(F.col('*'), operationFlag).select(batchSelect).drop('__operation_flag').select(F.col('*'),
-                                                                                                                                       nullsCol.alias('__pk_nulls_count'),
-                                                                                                                                       stagedNullsCol.alias('__u_pk_nulls_count'))
-        mergeDf = mergeDf.persist(StorageLevel.MEMORY_AND_DISK)
+        with elzyme.metrics.phase('nullKeys', batch=batchDf) as p:
+          targetDf = deltaTable.toDF()
+          u = targetDf.alias('u')
+          su = F.broadcast(batchDf).alias('staged_updates')
+          mergeDf = u.join(su, outerCond, 'right').select(F.col('*'), operationFlag).select(batchSelect).drop('__operation_flag').select(F.col('*'),
+                                                                                                                                         nullsCol.alias('__pk_nulls_count'),
+                                                                                                                                         stagedNullsCol.alias('__u_pk_nulls_count'))
+          mergeDf = p.output('candidates', mergeDf.persist(StorageLevel.MEMORY_AND_DISK))
+          if elzyme.metrics.enabled():
+            elzyme.metrics.count('nullKeyCandidateRows', mergeDf.count())
 #         if 'product_id' in deltaTableColumns:
 #           mergeDf.withColumnRenamed('_commit_version', '__commit_version').write.format('delta').mode('overwrite').save('/Users/leon.eller@databricks.com/tmp/error/merge')
         batchDf = mergeDf.alias('u').join(mergeDf.alias('staged_updates'), antiJoinCond, 'left_anti')
 #         if 'product_id' in deltaTableColumns:
 #           batchDf.withColumnRenamed('_commit_version', '__commit_version').write.format('delta').mode('overwrite').save('/Users/leon.eller@databricks.com/tmp/error/batch1')
-      self._doMerge(deltaTable, cond, primaryKeys, windowSpec, updateCols, matchCondition, batchDf, batchId)
+      with elzyme.metrics.phase('merge', batch=batchDf):
+        self._doMerge(deltaTable, cond, primaryKeys, updateCols, updateClauses, deleteCondition, batchDf, batchId)
+      elzyme.metrics.countMerge(deltaTable, mergeTransaction, batchId)
       if mergeDf is not None:
          mergeDf.unpersist()
-
-    return StreamingJoin(self._left,
+      if dedupedDf is not None:
+        dedupedDf.unpersist()
+
+    def mergeBatch(batchDf, batchId, batchDedupOrder = dedupOrder):
+      # bound to the batch session, where MergeTransaction sets the commit tags, so the tags reach the MERGE commit
+      deltaTable = deltaTableForFunc(batchDf.sparkSession)
+      # A batch replayed after its MERGE committed but before the checkpoint did is skipped without being recomputed
+      if not mergeTransaction.isCommitted(deltaTable, batchId):
+        mergeTransaction.run(batchDf, batchId, lambda: mergeDedupedBatch(deltaTable, batchDf, batchId, batchDedupOrder))
+      if keyValueSink is not None:
+        keyValueSink.apply(deltaTable, tableName, primaryKeys, batchId, mergeTransaction)
+
+    mergeFunc = mergeBatch
+    coalescer = None
+    if self._coalesceOptions is not None:
+      coalescer = self._createCoalescer(tableName, path, mergeTransaction, lambda df, batchId: mergeBatch(df, batchId, coalesceDedupOrder))
+      mergeFunc = coalescer.add
+    writer = StreamingJoin(self._left,
                self._right,
                self._joinType,
                mergeFunc).join(self._joinExpr,
                                self._transformFunc,
                                self._selectCols,
                                self._finalSelectCols)._chainStreamingQuery(self._dependentQuery, self._upstreamJoinCond)
+    if coalescer is not None:
+      writer._addFlushFunc(coalescer.flush)
+    return writer._addMergeTransaction(mergeTransaction)._setExplain(lambda: self._explainStage(tableName))
+
+  def _explainStage(self, tableName):
+    primaryKeys, sequenceColumns, pks, condInitial = self._mergeKeys()
+    lines = [f"{self._joinType} join of {self._left.name()} and {self._right.name()} into {tableName if tableName is not None else '(no target yet)'}",
+             f'input {self._left.name()}: {self._left.sizeEstimate()}',
+             f'input {self._right.name()}: {self._right.sizeEstimate()}',
+             f'primary keys: {primaryKeys}',
+             f'sequence columns: {sequenceColumns}',
+             f'merge keys: {pks[0]}',
+             f'nullable merge keys: {pks[1]}',
+             f'merge condition: {condInitial}']
+    if len(pks[1]) > 0:
+      lines.append(f'outer match condition: {self._mergeCondition(pks[0], pks[1])}')
+    if self._partitionColumns is not None and len(self._partitionColumns) > 0:
+      lines.append('partition columns: ' + ', '.join([pc.column() + (f' (pruned, up to {pc.maxValues()} values)' if pc.isStaticPruned() else '') for pc in self._partitionColumns]))
+    lines.append("strategy: each side's changes are broadcast and joined to the other side's snapshot pinned at the batch's last commit version, then outer joined on the primary keys")
+    if len(pks[1]) > 0:
+      lines.append('merge: rows with null keys are matched to the target first and superseded rows removed with an anti join')
+    if self._rowCountColumn is not None:
+      lines.append(f'rows whose {self._rowCountColumn} drops to zero are deleted')
+    if self._coalesceOptions is not None:
+      lines.append(f'coalesced writes: {self._coalesceOptions}')
+    return lines
+
+  def explain(self):
+    stages = self._dependentQuery._explainStages() if self._dependentQuery is not None else []
+    print(elzyme.utils.formatStages(stages + [self._explainStage(None)]))
 
   def stagingIndex(self):
     if self._dependentQuery is not None:
@@ -584,11 +711,12 @@ class StreamToStreamJoinWithConditionForEachBatch:
     from elzyme.streams import Stream
     if stagingPath is None:
       stagingPath = self.generateJoinStagingPath()
-    joinQuery = (
+    fingerprint = elzyme.utils.fingerprint(stagingPath, self)
+    joinQuery = StagingRegistry.attach(fingerprint, stagingPath, lambda: (
                   self.writeToPath(f'{stagingPath}/data')
                       .option('checkpointLocation', f'{stagingPath}/cp')
                       .queryName(self.generateJoinName())
-                )
+                ))
     primaryKeys = self._safeMergeLists(self._left.getPrimaryKeys(), self._right.getPrimaryKeys())
     if self._upstreamJoinCond is not None:
       def func():
@@ -600,7 +728,8 @@ class StreamToStreamJoinWithConditionForEachBatch:
       joinCondFunc = func
     else:
       joinCondFunc = lambda: self._nonNullAndNullPrimaryKeys(self._joinType, [pk for pk in primaryKeys if pk in self._left.getPrimaryKeys()], [pk for pk in primaryKeys if pk in self._right.getPrimaryKeys()])
-    return operationFunc(Stream.fromPath(f'{stagingPath}/data').setName(f'{self._left.name()}_{self._right.name()}').primaryKeys(*primaryKeys), joinQuery, joinCondFunc)
+    # a staging table that deletes emptied rows feeds the deletes downstream as retractions
+    return operationFunc(Stream.fromPath(f'{stagingPath}/data', retractDeletes = self._rowCountColumn is not None).setName(f'{self._left.name()}_{self._right.name()}').primaryKeys(*primaryKeys).setSource(('stage', fingerprint)), joinQuery, joinCondFunc)
 
   def join(self, right, joinType = 'inner', stagingPath = None):
     return self._createStagingStream(stagingPath,
@@ -610,11 +739,30 @@ class StreamToStreamJoinWithConditionForEachBatch:
     return self._createStagingStream(stagingPath,
                           lambda stream, joinQuery, joinCondFunc: stream.groupBy(*cols)._chainStreamingQuery(joinQuery, joinCondFunc))
 
+  def rollup(self, *cols, stagingPath = None):
+    return self._createStagingStream(stagingPath,
+                          lambda stream, joinQuery, joinCondFunc: stream.rollup(*cols)._chainStreamingQuery(joinQuery, joinCondFunc))
+
+  def cube(self, *cols, stagingPath = None):
+    return self._createStagingStream(stagingPath,
+                          lambda stream, joinQuery, joinCondFunc: stream.cube(*cols)._chainStreamingQuery(joinQuery, joinCondFunc))
+
+  def groupingSets(self, groupingSets, *cols, stagingPath = None):
+    return self._createStagingStream(stagingPath,
+                          lambda stream, joinQuery, joinCondFunc: stream.groupingSets(groupingSets, *cols)._chainStreamingQuery(joinQuery, joinCondFunc))
+
   def writeToPath(self, path):
-    return self._writeToTarget(lambda: DeltaTable.forPath(spark, path), f'delta.`{path}`', path)
+    return self._writeToTarget(lambda session = spark: DeltaTable.forPath(session, path), f'delta.`{path}`', path)
 
   def writeToTable(self, tableName):
-    return self._writeToTarget(lambda: DeltaTable.forName(spark, tableName), tableName, None)
+    return self._writeToTarget(lambda session = spark: DeltaTable.forName(session, tableName), tableName, None)
+
+  def writeToKeyValue(self, kvPath, path = None, tableName = None):
+    if path is not None:
+      return self._writeToTarget(lambda session = spark: DeltaTable.forPath(session, path), f'delta.`{path}`', path, KeyValueSink(kvPath))
+    if tableName is not None:
+      return self._writeToTarget(lambda session = spark: DeltaTable.forName(session, tableName), tableName, None, KeyValueSink(kvPath))
+    raise Exception('Either path or tableName of the Delta target backing the key-value store must be specified')
 
 class StreamToStreamJoinWithCondition:
   _left = None
@@ -625,6 +773,7 @@ class StreamToStreamJoinWithCondition:
   _dependentQuery = None
   _partitionColumns = None
   _upstreamJoinCond = None
+  _joinKeys = None
 
   def __init__(self,
                left,
@@ -632,13 +781,15 @@ class StreamToStreamJoinWithCondition:
                joinType,
                onCondition,
                transformFunc = None,
-               partitionColumns = None):
+               partitionColumns = None,
+               joinKeys = None):
     self._left = left
     self._right = right
     self._joinType = joinType
     self._joinExpr = onCondition
     self._transformFunc = transformFunc
     self._partitionColumns = partitionColumns
+    self._joinKeys = joinKeys
 
   def _chainStreamingQuery(self, dependentQuery, upstreamJoinCond):
     self._dependentQuery = dependentQuery
@@ -675,9 +826,15 @@ class StreamToStreamJoinWithCondition:
   def stagingPath(self):
     return self.select('*').generateJoinStagingPath()
 
+  def explain(self):
+    return self.select('*').explain()
+
   def partitionBy(self, *columns):
     return self.select('*').partitionBy(*columns)
 
+  def coalesceWrites(self, maxRows = None, maxBytes = None, maxLatencySecs = None, bufferPath = None):
+    return self.select('*').coalesceWrites(maxRows, maxBytes, maxLatencySecs, bufferPath)
+
   def drop(self, column):
     if column.stream() == self._right.stream():
       func = lambda f, l, r: f.drop(r[column.columnName()])
@@ -691,9 +848,32 @@ class StreamToStreamJoinWithCondition:
   def join(self, right, joinType = 'inner', stagingPath = None):
     return self.select('*').join(right, joinType, stagingPath)
 
-  def groupBy(self, *cols, stagingPath = None):
+  def _canPreAggregate(self, cols):
+    # only plain onKeys() joins that match each left row to at most one right row can be aggregated before the join
+    if self._joinKeys is None or self._joinType not in ['left', 'inner']:
+      return False
+    rightPrimaryKeys = self._right.getPrimaryKeys()
+    if rightPrimaryKeys is None or len(rightPrimaryKeys) == 0 or not set(rightPrimaryKeys).issubset(self._joinKeys):
+      return False
+    leftColumns = self._left.columns()
+    return all(isinstance(c, str) and c in leftColumns for c in cols) and set(self._joinKeys).issubset(cols)
+
+  def groupBy(self, *cols, stagingPath = None, preAggregate = False):
+    # opt-in, the pre-aggregated plan stages different tables than a running join-then-aggregate pipeline was checkpointed with
+    if preAggregate and self._canPreAggregate(cols):
+      from elzyme.aggs import PreAggregatingGroupBy
+      return PreAggregatingGroupBy(self, cols, stagingPath)
     return self.select("*").groupBy(*cols, stagingPath = stagingPath)
 
+  def rollup(self, *cols, stagingPath = None):
+    return self.select("*").rollup(*cols, stagingPath = stagingPath)
+
+  def cube(self, *cols, stagingPath = None):
+    return self.select("*").cube(*cols, stagingPath = stagingPath)
+
+  def groupingSets(self, groupingSets, *cols, stagingPath = None):
+    return self.select("*").groupingSets(groupingSets, *cols, stagingPath = stagingPath)
+
   def foreachBatch(self, mergeFunc):
     return self.select('*').foreachBatch(mergeFunc)
 
@@ -702,6 +882,9 @@ class StreamToStreamJoinWithCondition:
 
   def writeToTable(self, tableName):
     return self.select('*').writeToTable(tableName)
+
+  def writeToKeyValue(self, kvPath, path = None, tableName = None):
+    return self.select('*').writeToKeyValue(kvPath, path, tableName)
     
   def select(self, *selectCols):
     from elzyme.streams import ColumnSelector
@@ -0,0 +1,108 @@
+from databricks.sdk.runtime import *
+import sqlite3
+import itertools
+import json
+
+class KeyValueStore:
+  _path = None
+  _timeout = None
+
+  def __init__(self,
+               path,
+               timeout = 30):
+    self._path = path
+    self._timeout = timeout
+    with self._connect() as conn:
+      conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID')
+      # the last applied batchId is kept per appId, batchIds start again from 0 when a query's checkpoint is reset
+      conn.execute('CREATE TABLE IF NOT EXISTS kv_batches (app_id TEXT PRIMARY KEY, batch_id INTEGER NOT NULL) WITHOUT ROWID')
+
+  def _connect(self):
+    conn = sqlite3.connect(self._path, timeout = self._timeout)
+    # WAL lets services keep reading while a batch is being applied
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+  @staticmethod
+  def encodeKey(values):
+    return json.dumps(list(values), default = str)
+
+  def path(self):
+    return self._path
+
+  def lastBatchId(self, appId):
+    with self._connect() as conn:
+      row = conn.execute('SELECT batch_id FROM kv_batches WHERE app_id = ?', (appId,)).fetchone()
+    return row[0] if row is not None else None
+
+  def get(self, *keys):
+    with self._connect() as conn:
+      row = conn.execute('SELECT value FROM kv WHERE key = ?', (KeyValueStore.encodeKey(keys),)).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+  def apply(self, appId, batchId, deletes, upserts, chunkSize = 10000):
+    # deletes and upserts are iterables of (key, value) tuples, applied in one transaction together with the appId's batchId
+    # so a replayed batch is skipped and a failed one leaves no partial state behind
+    conn = self._connect()
+    try:
+      with conn:
+        row = conn.execute('SELECT batch_id FROM kv_batches WHERE app_id = ?', (appId,)).fetchone()
+        if row is not None and batchId <= row[0]:
+          return False
+        for chunk in KeyValueStore._chunks(deletes, chunkSize):
+          conn.executemany('DELETE FROM kv WHERE key = ?', [(k,) for k, v in chunk])
+        for chunk in KeyValueStore._chunks(upserts, chunkSize):
+          conn.executemany('INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value', chunk)
+        conn.execute('INSERT INTO kv_batches (app_id, batch_id) VALUES (?, ?) ON CONFLICT(app_id) DO UPDATE SET batch_id = excluded.batch_id', (appId, batchId))
+      return True
+    finally:
+      conn.close()
+
+  @staticmethod
+  def _chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+      chunk = list(itertools.islice(it, size))
+      if len(chunk) == 0:
+        return
+      yield chunk
+
+class KeyValueSink:
+  _store = None
+  excludedColumns = ['_change_type', '_commit_version', '_commit_timestamp']
+
+  def __init__(self,
+               path):
+    self._store = KeyValueStore(path)
+
+  def store(self):
+    return self._store
+
+  def apply(self, deltaTable, tableName, keyColumns, batchId, mergeTransaction):
+    # Mirror the rows changed by the batch's MERGE, read back from the target's CDF
+    appId = mergeTransaction.appId()
+    if appId is None:
+      raise Exception(f'Cannot mirror batch {batchId} of {tableName} to the key-value store without a streaming query id')
+    lastBatchId = self._store.lastBatchId(appId)
+    if lastBatchId is not None and batchId <= lastBatchId:
+      return False
+    version = mergeTransaction.committedVersion(deltaTable, batchId)
+    if version is None:
+      # the MERGE of this batch ran or was skipped as already committed, so its commit must be in the history
+      raise Exception(f'No MERGE commit of batch {batchId} found in the last {mergeTransaction.lookback()} versions of {tableName}')
+    changes = (
+      spark.read.format('delta')
+           .option('readChangeFeed', 'true')
+           .option('startingVersion', version)
+           .option('endingVersion', version)
+           .table(tableName)
+    )
+    valueColumns = [c for c in changes.columns if c not in KeyValueSink.excludedColumns and not c.startswith('__')]
+    changes = changes.persist()
+    try:
+      toKeyValue = lambda r: (KeyValueStore.encodeKey([r[k] for k in keyColumns]), json.dumps({c: r[c] for c in valueColumns}, default = str))
+      deletes = (toKeyValue(r) for r in changes.where("_change_type = 'update_preimage' OR _change_type = 'delete'").toLocalIterator())
+      upserts = (toKeyValue(r) for r in changes.where("_change_type = 'update_postimage' OR _change_type = 'insert'").toLocalIterator())
+      return self._store.apply(appId, batchId, deletes, upserts)
+    finally:
+      changes.unpersist()
\ No newline at end of file
@@ -0,0 +1,179 @@
+from databricks.sdk.runtime import *
+from contextlib import contextmanager
+import collections
+import datetime
+import queue
+import threading
+import time
+import warnings
+
+# The batch running on the current thread. Every microbatch of a stage runs its whole foreachBatch
+# function on one thread, so nested merge code can report phases without passing the batch around
+_current = threading.local()
+_hooks = []
+
+def addHook(hook):
+  """
+  Registers a hook called around every phase of every stage. A hook implements onPhaseStart(phase) and
+  onPhaseEnd(phase), where phase is the PhaseContext with the stage name, batchId, phase name and DataFrames.
+  """
+  _hooks.append(hook)
+  return hook
+
+def removeHook(hook):
+  _hooks.remove(hook)
+
+def hooksRegistered():
+  return len(_hooks) > 0
+
+def enabled():
+  return getattr(_current, 'record', None) is not None
+
+def count(name, value):
+  record = getattr(_current, 'record', None)
+  if record is not None and value is not None:
+    record['counts'][name] = record['counts'].get(name, 0) + int(value)
+
+class PhaseContext:
+  stage = None
+  batchId = None
+  name = None
+  dataFrames = None
+  durationSecs = None
+
+  def __init__(self, stage, batchId, name, dataFrames):
+    self.stage = stage
+    self.batchId = batchId
+    self.name = name
+    self.dataFrames = dataFrames
+
+  def output(self, name, df):
+    self.dataFrames[name] = df
+    return df
+
+class _NoPhase:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    return False
+
+  def output(self, name, df):
+    return df
+
+_noPhase = _NoPhase()
+
+@contextmanager
+def batch(stage, batchId, metricsSink = None):
+  record = None
+  if metricsSink is not None:
+    record = {'stage': stage, 'batchId': batchId, 'startedAt': datetime.datetime.now(), 'durationSecs': None, 'phases': {}, 'counts': {}}
+  startedAt = time.time()
+  _current.stage = stage
+  _current.batchId = batchId
+  _current.record = record
+  try:
+    yield record
+  finally:
+    _current.stage = None
+    _current.batchId = None
+    _current.record = None
+    if record is not None:
+      record['durationSecs'] = time.time() - startedAt
+      metricsSink._add(record)
+
+def phase(name, **dataFrames):
+  # Without metrics or hooks a phase is a shared no-op context, hooks see the input DataFrames passed here
+  # and the outputs the phase adds with output()
+  record = getattr(_current, 'record', None)
+  if record is None and len(_hooks) == 0:
+    return _noPhase
+  return _phase(record, name, dataFrames)
+
+def _callHook(hook, method, context):
+  # a failing hook is reported and skipped, it never fails the merge it observes
+  try:
+    getattr(hook, method)(context)
+  except Exception as e:
+    warnings.warn(f'Hook {hook!r} failed in {method} of phase {context.name} of stage {context.stage}: {e}')
+
+@contextmanager
+def _phase(record, name, dataFrames):
+  context = PhaseContext(getattr(_current, 'stage', None), getattr(_current, 'batchId', None), name, dataFrames)
+  hooks = list(_hooks)
+  for hook in hooks:
+    _callHook(hook, 'onPhaseStart', context)
+  startedAt = time.time()
+  try:
+    yield context
+  finally:
+    context.durationSecs = time.time() - startedAt
+    if record is not None:
+      record['phases'][name] = record['phases'].get(name, 0.0) + context.durationSecs
+    for hook in reversed(hooks):
+      _callHook(hook, 'onPhaseEnd', context)
+
+def countMerge(deltaTable, mergeTransaction, batchId):
+  # row and file counts of the batch's MERGE, read from its commit info rather than recomputed
+  if not enabled():
+    return
+  operationMetrics = mergeTransaction.operationMetrics(deltaTable, batchId) or {}
+  for name in ['numTargetRowsInserted', 'numTargetRowsUpdated', 'numTargetRowsDeleted', 'numTargetFilesAdded', 'numTargetFilesRemoved']:
+    count(name, operationMetrics.get(name))
+
+class MetricsSink:
+  _path = None
+  _records = None
+  _queue = None
+  _thread = None
+  _lock = None
+  _error = None
+  schema = 'stage STRING, batchId BIGINT, startedAt TIMESTAMP, durationSecs DOUBLE, phases MAP<STRING, DOUBLE>, counts MAP<STRING, BIGINT>'
+
+  def __init__(self,
+               path,
+               maxRecords = 1000):
+    self._path = path
+    self._records = collections.deque(maxlen = maxRecords)
+    self._queue = queue.Queue()
+    self._lock = threading.Lock()
+
+  def path(self):
+    return self._path
+
+  def _add(self, record):
+    self._records.append(record)
+    self._queue.put(record)
+    with self._lock:
+      if self._thread is None:
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+  def _run(self):
+    # records are appended to the metrics table off the batch thread, several at a time when batches are quick
+    while True:
+      records = [self._queue.get()]
+      while not self._queue.empty():
+        records.append(self._queue.get())
+      try:
+        rows = [(r['stage'], r['batchId'], r['startedAt'], r['durationSecs'], r['phases'], r['counts']) for r in records]
+        spark.createDataFrame(rows, MetricsSink.schema).write.format('delta').mode('append').save(self._path)
+      except Exception as e:
+        # raised by flush() on the caller's thread, a failed write must not go unnoticed
+        self._error = e
+      finally:
+        for r in records:
+          self._queue.task_done()
+
+  def flush(self):
+    self._queue.join()
+    if self._error is not None:
+      error = self._error
+      self._error = None
+      raise Exception(f'Failed to write batch metrics to {self._path}') from error
+
+  def records(self):
+    return list(self._records)
+
+  def table(self):
+    return spark.read.format('delta').load(self._path)
@@ -0,0 +1,152 @@
+from databricks.sdk.runtime import *
+from pyspark.sql import functions as F
+from pyspark.sql.types import StructType, StructField, ArrayType, LongType
+from delta.tables import *
+from pyspark import StorageLevel
+from functools import reduce
+import elzyme.utils
+
+class MinMaxState:
+  _agg = None
+  _keyCols = None
+  _groupBy = None
+  _statePath = None
+  _stream = None
+  _mergeTransaction = None
+  _persisted = None
+  _requiredSize = None
+
+  def __init__(self,
+               agg,
+               keyCols,
+               groupBy,
+               statePath,
+               stream,
+               mergeTransaction,
+               requiredSize = 1):
+    self._agg = agg
+    self._keyCols = keyCols
+    self._groupBy = groupBy
+    self._statePath = statePath
+    self._stream = stream
+    self._mergeTransaction = mergeTransaction
+    self._requiredSize = requiredSize
+    self._persisted = []
+
+  @staticmethod
+  def _keysCond(l, r, keyCols):
+    return reduce(lambda a, b: a & b, [F.col(f'{l}.{k}').eqNullSafe(F.col(f'{r}.{k}')) for k in keyCols])
+
+  @staticmethod
+  def _emptyAndComplete(prefix = ''):
+    return f'(size({prefix}__values) < 1 OR {prefix}__values is null) AND {prefix}__floor is null'
+
+  def statePath(self):
+    return self._statePath
+
+  def create(self, keyFields, valueType):
+    # Per group we keep the bufferSize most extreme distinct values with their counts. __floor is the most extreme
+    # value trimmed from the buffer, values beyond it are not tracked and a null __floor means the buffer holds every value
+    entryType = StructType([StructField('__value', valueType), StructField('__count', LongType())])
+    schema = StructType(list(keyFields) + [StructField('__values', ArrayType(entryType)), StructField('__floor', valueType)])
+    spark.sql(f"CREATE TABLE IF NOT EXISTS delta.`{self._statePath}` ({schema.toDDL()}) USING DELTA")
+    return self
+
+  def _persist(self, df):
+    df = df.persist(StorageLevel.MEMORY_AND_DISK)
+    self._persisted.append(df)
+    return df
+
+  def _sorted(self, entries):
+    return entries.groupBy(*self._keyCols).agg(F.sort_array(F.collect_list(F.struct('__value', '__count')), asc = self._agg.isMin()).alias('__all'))
+
+  def _bounded(self, df, floorCol):
+    k = self._agg.bufferSize()
+    return df.select(*self._keyCols,
+                     F.slice('__all', 1, k).alias('__values'),
+                     F.when(F.size('__all') > k, F.element_at('__all', k + 1)['__value']).otherwise(floorCol).alias('__floor'))
+
+  def _beyondFloor(self, value, floor):
+    if self._agg.isMin():
+      return floor.isNull() | (value < floor)
+    return floor.isNull() | (value > floor)
+
+  def _counts(self, df, weight):
+    value = self._agg.valueColumn()
+    return (
+      self._groupBy.prepare(df).where(value.isNotNull())
+        .groupBy(*self._groupBy.columns(), value.alias('__value'))
+        .agg(F.sum(weight).alias('__count'))
+        .where('__count != 0')
+    )
+
+  def _update(self, sourceBatchDf, batchKeys, stateTable):
+    keys = self._keyCols
+    version = stateTable.history(1).select('version').collect()[0][0]
+    stateDf = spark.read.format('delta').option('versionAsOf', version).load(self._statePath)
+    current = (
+      stateDf.alias('s').join(F.broadcast(batchKeys).alias('k'), MinMaxState._keysCond('s', 'k', keys), 'right')
+             .select(*[F.col(f'k.{k}').alias(k) for k in keys], F.col('s.__values').alias('__values'), F.col('s.__floor').alias('__floor'))
+    )
+    current = self._persist(current)
+    entries = current.select(*keys, F.explode('__values').alias('__e')).select(*keys, '__e.__value', '__e.__count')
+    deltas = self._counts(sourceBatchDf, F.when(F.col('_change_type') == 'update_preimage', F.lit(-1)).otherwise(F.lit(1)))
+    # changes to values beyond the floor are not tracked, if they ever matter the group is recomputed from the source
+    deltas = (
+      deltas.alias('d').join(current.alias('c'), MinMaxState._keysCond('d', 'c', keys), 'left')
+            .where(self._beyondFloor(F.col('d.__value'), F.col('c.__floor')))
+            .select(*[F.col(f'd.{k}').alias(k) for k in keys], 'd.__value', 'd.__count')
+    )
+    combined = entries.unionByName(deltas).groupBy(*keys, '__value').agg(F.sum('__count').alias('__count')).where('__count > 0')
+    newState = (
+      current.alias('c').join(self._sorted(combined).alias('a'), MinMaxState._keysCond('c', 'a', keys), 'left')
+             .select(*[F.col(f'c.{k}').alias(k) for k in keys], F.col('a.__all').alias('__all'), F.col('c.__floor').alias('__oldFloor'))
+    )
+    newState = self._persist(self._bounded(newState, F.col('__oldFloor')))
+    exhausted = newState.where(f'(size(__values) < {self._requiredSize} OR __values is null) AND __floor is not null').select(*keys)
+    if exhausted.count() > 0:
+      # the reserve of these groups was used up by retractions so the buffers are rebuilt from the source snapshot
+      sourceVersion = sourceBatchDf.agg(F.max('_commit_version')).collect()[0][0]
+      recomputed = self._counts(self._stream.static(sourceVersion), F.lit(1))
+      recomputed = recomputed.alias('r').join(F.broadcast(exhausted).alias('x'), MinMaxState._keysCond('r', 'x', keys), 'left_semi')
+      recomputed = self._bounded(self._sorted(recomputed), F.lit(None))
+      recomputed = (
+        exhausted.alias('x').join(recomputed.alias('r'), MinMaxState._keysCond('x', 'r', keys), 'left')
+                 .select(*[F.col(f'x.{k}').alias(k) for k in keys], 'r.__values', 'r.__floor')
+      )
+      newState = newState.alias('n').join(exhausted.alias('x'), MinMaxState._keysCond('n', 'x', keys), 'left_anti').unionByName(recomputed)
+      newState = self._persist(newState)
+      newState.count()
+    (
+      stateTable.alias('u').merge(newState.alias('staged_updates'), MinMaxState._keysCond('u', 'staged_updates', keys))
+                .whenMatchedDelete(condition = MinMaxState._emptyAndComplete('staged_updates.'))
+                .whenMatchedUpdate(set = {'__values': F.col('staged_updates.__values'), '__floor': F.col('staged_updates.__floor')})
+                .whenNotMatchedInsert(condition = f'NOT ({MinMaxState._emptyAndComplete("staged_updates.")})',
+                                      values = {c: F.col(f'staged_updates.{c}') for c in keys + ['__values', '__floor']})
+                .execute()
+    )
+    return newState
+
+  def update(self, sourceBatchDf, batchKeys, batchId):
+    keys = self._keyCols
+    stateTable = DeltaTable.forPath(sourceBatchDf.sparkSession, self._statePath)
+    if self._mergeTransaction.isCommitted(stateTable, batchId):
+      # the state already reflects this batch, it was merged before the target MERGE failed
+      return self._persist(stateTable.toDF().alias('s').join(F.broadcast(batchKeys).alias('k'), MinMaxState._keysCond('s', 'k', keys), 'left_semi'))
+    return self._update(sourceBatchDf, batchKeys, stateTable)
+
+  def apply(self, sourceBatchDf, mergeBatchDf, batchId):
+    keys = self._keyCols
+    name = self._agg.name()
+    newState = self.update(sourceBatchDf, mergeBatchDf.select(*keys).distinct(), batchId)
+    extremes = newState.select(*keys, F.when(F.size('__values') > 0, F.element_at('__values', 1)['__value']).alias(name))
+    return (
+      mergeBatchDf.drop(name).alias('b')
+                  .join(extremes.alias('x'), MinMaxState._keysCond('b', 'x', keys), 'left')
+                  .select('b.*', F.col(f'x.{name}'))
+    )
+
+  def cleanup(self):
+    for df in self._persisted:
+      df.unpersist()
+    self._persisted.clear()
\ No newline at end of file
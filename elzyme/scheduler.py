@@ -0,0 +1,116 @@
+from databricks.sdk.runtime import *
+import elzyme.metrics
+import threading
+import uuid
+import warnings
+
+class StageSlots:
+  _limit = None
+  _running = 0
+  _waiting = None
+  _condition = None
+
+  def __init__(self, limit):
+    self._limit = limit
+    self._running = 0
+    self._waiting = []
+    self._condition = threading.Condition()
+
+  def acquire(self, stage):
+    # When every slot is taken the most downstream waiting stage goes first so data already produced upstream
+    # drains through the pipeline before upstream stages pile up more
+    with self._condition:
+      self._waiting.append(stage)
+      self._condition.wait_for(lambda: self._running < self._limit and stage == max(self._waiting))
+      self._waiting.remove(stage)
+      self._running += 1
+
+  def release(self):
+    with self._condition:
+      self._running -= 1
+      self._condition.notify_all()
+
+class StageGate:
+  _func = None
+  _stage = None
+  _slots = None
+  _metricsSink = None
+  _stageName = None
+
+  def __init__(self, func):
+    self._func = func
+
+  def assign(self, stage, slots):
+    self._stage = stage
+    self._slots = slots
+    return self
+
+  def setMetrics(self, metricsSink, stageName):
+    self._metricsSink = metricsSink
+    self._stageName = stageName
+    return self
+
+  def _run(self, batchDf, batchId):
+    if self._metricsSink is None and not elzyme.metrics.hooksRegistered():
+      return self._func(batchDf, batchId)
+    with elzyme.metrics.batch(self._stageName, batchId, self._metricsSink):
+      return self._func(batchDf, batchId)
+
+  def __call__(self, batchDf, batchId):
+    if self._slots is None:
+      return self._run(batchDf, batchId)
+    self._slots.acquire(self._stage)
+    try:
+      return self._run(batchDf, batchId)
+    finally:
+      self._slots.release()
+
+class PipelineScheduler:
+  _name = None
+  _weight = None
+  _weightPerStage = None
+  _minShare = None
+  _minSharePerStage = None
+  _slots = None
+
+  def __init__(self,
+               name = None,
+               weight = 1,
+               weightPerStage = 1,
+               minShare = 0,
+               minSharePerStage = 0,
+               maxConcurrentStages = None):
+    self._name = name if name is not None else str(uuid.uuid4())
+    self._weight = weight
+    self._weightPerStage = weightPerStage
+    self._minShare = minShare
+    self._minSharePerStage = minSharePerStage
+    self._slots = StageSlots(maxConcurrentStages) if maxConcurrentStages is not None else None
+
+  def _hasPoolSettings(self):
+    return self._weight != 1 or self._weightPerStage != 1 or self._minShare != 0 or self._minSharePerStage != 0
+
+  def poolName(self, stage):
+    return f'{self._name}_stage{stage}'
+
+  def _createPool(self, name, weight, minShare):
+    # Pools created on the fly by spark.scheduler.pool get weight 1 and minShare 0, so register them up front.
+    # Where the scheduler is not reachable, e.g. on shared clusters, stages still get pools of their own with the
+    # default settings, which is only acceptable when no weights or min-shares were asked for
+    try:
+      jvm = spark.sparkContext._jvm
+      rootPool = spark.sparkContext._jsc.sc().taskScheduler().rootPool()
+      if rootPool.getSchedulableByName(name) is None:
+        rootPool.addSchedulable(jvm.org.apache.spark.scheduler.Pool(name, jvm.org.apache.spark.scheduler.SchedulingMode.FAIR(), minShare, weight))
+    except Exception as e:
+      if self._hasPoolSettings():
+        raise Exception(f'Could not create scheduler pool {name} with weight {weight} and minShare {minShare}') from e
+      warnings.warn(f'Could not create scheduler pool {name}, it is created with the default settings on first use: {e}')
+
+  def startStage(self, stage, gates):
+    # Stages are numbered from the most upstream query, downstream stages get the larger weights and min-shares
+    name = self.poolName(stage)
+    self._createPool(name, self._weight + stage * self._weightPerStage, self._minShare + stage * self._minSharePerStage)
+    for gate in gates:
+      gate.assign(stage, self._slots)
+    spark.sparkContext.setLocalProperty("spark.scheduler.pool", name)
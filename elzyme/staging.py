@@ -0,0 +1,23 @@
+from databricks.sdk.runtime import *
+import threading
+
+class StagingRegistry:
+  _stages = {}
+  _paths = {}
+  _lock = threading.Lock()
+
+  @staticmethod
+  def attach(fingerprint, stagingPath, createFunc):
+    # Staging stages are keyed by the fingerprint of their plan, so a pipeline built from the same sources, condition,
+    # selects and transforms as an earlier one reuses its writer, and starting it attaches to the running query
+    with StagingRegistry._lock:
+      writer = StagingRegistry._stages.get(fingerprint)
+      if writer is not None:
+        return writer
+      other = StagingRegistry._paths.get(stagingPath)
+      if other is not None and other != fingerprint and StagingRegistry._stages[other].isActive():
+        raise Exception(f'Staging path {stagingPath} is already used by a different running stage, specify stagingPath to separate them')
+      writer = createFunc()
+      StagingRegistry._stages[fingerprint] = writer
+      StagingRegistry._paths[stagingPath] = fingerprint
+      return writer
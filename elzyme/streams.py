@@ -2,8 +2,14 @@ from databricks.sdk.runtime import *
 from pyspark.sql import functions as F
 from elzyme.joins import StreamToStreamJoin, ColumnRef
 from elzyme.aggs import GroupBy
-import uuid
+from elzyme.scheduler import PipelineScheduler
+from elzyme.metrics import MetricsSink
+import elzyme.utils
+from pyspark.sql.streaming import StreamingQueryListener
 import os
+import re
+import threading
+import time
 from delta.tables import *
 
 spark.conf.set("spark.databricks.adaptive.autoBroadcastJoinThreshold", "2GB")
@@ -56,12 +62,14 @@ class ColumnSelector:
 class PartitionColumn:
   _column = None
   _staticPruned = False
+  _maxValues = None
 
   def __init__(self,
                column):
     if isinstance(column, prune):
       self._column = column.column()
       self._staticPruned = True
+      self._maxValues = column.maxValues()
     else:
       self._column = column
       self._staticPruned = False
@@ -72,16 +80,25 @@ class PartitionColumn:
   def isStaticPruned(self):
     return self._staticPruned
 
+  def maxValues(self):
+    return self._maxValues
+
 class prune:
   _column = None
+  _maxValues = None
 
   def __init__(self,
-               column):
+               column,
+               maxValues = 1000):
     self._column = column
+    self._maxValues = maxValues
 
   def column(self):
     return self._column
 
+  def maxValues(self):
+    return self._maxValues
+
 class Stream:
   _stream = None
   _staticReader = None
@@ -91,6 +108,8 @@ class Stream:
   _path = None
   _name = None
   _isTable = None
+  _source = None
+  _transforms = None
   excludedColumns = ['_commit_version', '_change_type']
 
   def __init__(self,
@@ -100,6 +119,7 @@ class Stream:
     self._stream = stream
     self._staticReader = staticReader
     self._isTable = isTable
+    self._transforms = []
   
   @staticmethod
   def readAtVersion(reader, version = None):
@@ -110,24 +130,31 @@ class Stream:
     return loader
     
   @staticmethod
-  def fromPath(path, startingVersion = None):
+  def _changes(cdfStream, retractDeletes):
+    if retractDeletes:
+      # a deleted row is retracted downstream like the preimage of an update with no postimage
+      return cdfStream.withColumn('_change_type', F.when(F.col('_change_type') == 'delete', F.lit('update_preimage')).otherwise(F.col('_change_type'))).drop('_commit_timestamp')
+    return cdfStream.where("_change_type != 'delete'").drop('_commit_timestamp')
+
+  @staticmethod
+  def fromPath(path, startingVersion = None, retractDeletes = False):
     cdfStream = spark.readStream.format('delta').option("readChangeFeed", "true").option("maxBytesPerTrigger", "1g")
     if startingVersion is not None:
       cdfStream = cdfStream.option("startingVersion", f"{startingVersion}")
     cdfStream = cdfStream.load(path)
-    cdfStream = cdfStream.where("_change_type != 'delete'").drop('_commit_timestamp')
+    cdfStream = Stream._changes(cdfStream, retractDeletes)
     reader = spark.read.format('delta')
-    return Stream(cdfStream, lambda v: Stream.readAtVersion(reader, v).load(path), False).setPath(path)
+    return Stream(cdfStream, lambda v: Stream.readAtVersion(reader, v).load(path), False).setPath(path).setSource(('path', path, startingVersion, retractDeletes))
 
   @staticmethod
-  def fromTable(tableName, startingVersion = None):
+  def fromTable(tableName, startingVersion = None, retractDeletes = False):
     cdfStream = spark.readStream.format('delta').option("readChangeFeed", "true").option("maxBytesPerTrigger", "1g")
     if startingVersion is not None:
       cdfStream = cdfStream.option("startingVersion", f"{startingVersion}")
     cdfStream = cdfStream.table(tableName)
-    cdfStream = cdfStream.where("_change_type != 'delete'").drop('_commit_timestamp')
+    cdfStream = Stream._changes(cdfStream, retractDeletes)
     reader = spark.read.format('delta')
-    return Stream(cdfStream, lambda v: Stream.readAtVersion(reader, v).table(tableName), True).setName(tableName).setPath(tableName)
+    return Stream(cdfStream, lambda v: Stream.readAtVersion(reader, v).table(tableName), True).setName(tableName).setPath(tableName).setSource(('table', tableName, startingVersion, retractDeletes))
 
   def __getitem__(self, key):
     return ColumnSelector(self, key)
@@ -148,6 +175,13 @@ class Stream:
   def path(self):
     return self._path
 
+  def setSource(self, source):
+    self._source = source
+    return self
+
+  def fingerprint(self):
+    return elzyme.utils.fingerprint(self._source, self._transforms, self._primaryKeys, self._sequenceColumns)
+
   def columns(self):
     return [c for c in self._stream.columns if c not in Stream.excludedColumns]
 
@@ -166,6 +200,24 @@ class Stream:
       return DeltaTable.forName(spark, self.name()).history(1).select('version').collect()[0][0]
     return DeltaTable.forPath(spark, self.path()).history(1).select('version').collect()[0][0]
 
+  def _detail(self):
+    # size and file count come from the Delta log, no data is read
+    try:
+      deltaTable = DeltaTable.forName(spark, self.name()) if self._isTable is True else DeltaTable.forPath(spark, self.path())
+      return deltaTable.detail().select('sizeInBytes', 'numFiles').collect()[0]
+    except Exception:
+      return None
+
+  def sizeInBytes(self):
+    detail = self._detail()
+    return detail[0] if detail is not None else None
+
+  def sizeEstimate(self):
+    detail = self._detail()
+    if detail is None:
+      return 'not created yet'
+    return f'{detail[0] / (1024 * 1024):.1f} MB in {detail[1]} files'
+
   def primaryKeys(self, *keys):
     self._primaryKeys = keys
     return self
@@ -185,23 +237,121 @@ class Stream:
   
   def groupBy(self, *cols):
     return GroupBy(self, cols)
+
+  def rollup(self, *cols):
+    return GroupBy(self, cols, GroupBy.rollupSets(cols))
+
+  def cube(self, *cols):
+    return GroupBy(self, cols, GroupBy.cubeSets(cols))
+
+  def groupingSets(self, groupingSets, *cols):
+    if len(cols) == 0:
+      cols = tuple(dict.fromkeys([c for gs in groupingSets for c in gs]))
+    return GroupBy(self, cols, groupingSets)
   
   def to(self, func):
+    self._transforms.append(func)
     self._stream = func(self._stream)
 #     self._static = func(self._static)
     reader = self._staticReader
     self._staticReader = lambda v: func(reader(v))
     return self
 
+class ProgressListener(StreamingQueryListener):
+  _queryIds = None
+  _condition = None
+  _events = 0
+
+  def __init__(self, queryIds):
+    self._queryIds = set(queryIds)
+    self._condition = threading.Condition()
+    self._events = 0
+
+  def _notify(self, queryId):
+    if str(queryId) in self._queryIds:
+      with self._condition:
+        self._events += 1
+        self._condition.notify_all()
+
+  def onQueryStarted(self, event):
+    pass
+
+  def onQueryProgress(self, event):
+    self._notify(event.progress.id)
+
+  def onQueryIdle(self, event):
+    self._notify(event.id)
+
+  def onQueryTerminated(self, event):
+    self._notify(event.id)
+
+  def events(self):
+    with self._condition:
+      return self._events
+
+  def waitForEvent(self, lastEvents, timeout):
+    with self._condition:
+      self._condition.wait_for(lambda: self._events != lastEvents, timeout)
+      return self._events
+
+  @staticmethod
+  def _latestVersion(description):
+    m = re.fullmatch(r'DeltaSource\[(.*)\]', description)
+    if m is None:
+      return None
+    return DeltaTable.forPath(spark, m.group(1)).history(1).select('version').collect()[0][0]
+
+  @staticmethod
+  def caughtUp(query):
+    if not query.isActive:
+      # rethrows the failure of a query that terminated with an error
+      query.awaitTermination()
+      return True
+    lp = query.lastProgress
+    if lp is None:
+      return False
+    for source in lp['sources']:
+      metrics = source.get('metrics') or {}
+      if int(metrics.get('numBytesOutstanding', 0)) > 0:
+        return False
+      endOffset = source.get('endOffset')
+      if not isinstance(endOffset, dict) or endOffset.get('reservoirVersion') is None:
+        return False
+      # a Delta source offset moves to the next version once every change of the current one has been processed
+      latestVersion = ProgressListener._latestVersion(source['description'])
+      if latestVersion is None:
+        startOffset = source.get('startOffset')
+        if not isinstance(startOffset, dict) or startOffset.get('reservoirVersion') != endOffset['reservoirVersion']:
+          return False
+      elif endOffset['reservoirVersion'] <= latestVersion:
+        return False
+    return True
+
+  @staticmethod
+  def idle(query):
+    # the last batch read nothing and nothing is left to read, which is all an active query can report once its
+    # source is only followed by commits it never reads, like auto compaction's dataChange=false commits
+    lp = query.lastProgress
+    if lp is None or int(lp.get('numInputRows', 0)) > 0:
+      return False
+    return all(int((source.get('metrics') or {}).get('numBytesOutstanding', 0)) == 0 for source in lp['sources'])
+
 class StreamingQuery:
   _streamingQuery = None
   _dependentQuery = None
+  _flushFuncs = None
+  _attached = 1
+  _metricsSink = None
 
   def __init__(self,
                streamingQuery,
-               dependentQuery):
+               dependentQuery,
+               flushFuncs = None,
+               metricsSink = None):
     self._streamingQuery = streamingQuery
     self._dependentQuery = dependentQuery
+    self._flushFuncs = flushFuncs if flushFuncs is not None else []
+    self._metricsSink = metricsSink
   
   @property
   def lastProgress(self):
@@ -231,83 +381,212 @@ class StreamingQuery:
       self._dependentQuery.awaitTermination(timeout)
     return self._streamingQuery.awaitTermination(timeout)
 
+  def _attach(self):
+    self._attached += 1
+    return self
+
   def stop(self):
+    # a staging stage shared by several pipelines keeps running until the last of them stops
+    self._attached -= 1
+    if self._attached > 0:
+      return
     if self._dependentQuery is not None:
       self._dependentQuery.stop()
     return self._streamingQuery.stop()
+
+  def flush(self):
+    # Merges any writes still held back by coalesceWrites(), upstream stages first
+    flushed = False
+    if self._dependentQuery is not None:
+      flushed = self._dependentQuery.flush()
+    for func in self._flushFuncs:
+      flushed = func() or flushed
+    return flushed
   
-  def awaitAllProcessed(self, shutdownLatencySecs = 30):
-    awaitTerminationTimeout = 5
-    maxConsecutiveNoBytesOutstandingMicrobatchRetries = int(shutdownLatencySecs / awaitTerminationTimeout + 0.5)
-    lastBatches = {}
-    batches = {}
-    testTryCount = 0
-    while(True):
-      lp = self.lastProgress
-      sources = [lp[k]['sources'] for k in lp if lp[k] is not None]
-      if len(sources) == len(lp):
-        bytes = [int(s['metrics']['numBytesOutstanding']) if s.get('metrics') is not None else 1 for sarr in sources for s in sarr]
-        startOffsets = [s['startOffset']['reservoirVersion'] if s.get('startOffset') is not None and s['startOffset'].get('reservoirVersion') is not None else 0 for sarr in sources for s in sarr]
-        endOffsets = [s['endOffset']['reservoirVersion'] if s.get('endOffset') is not None and s['endOffset'].get('reservoirVersion') is not None else 0 for sarr in sources for s in sarr]
-        offsets = [o for o in zip(startOffsets, endOffsets) if o[0] != o[1]]
-        batches = {k: lp[k]['timestamp'] for k in lp}
-        updatedBatches = [batches[bi] for bi in batches if bi not in lastBatches or batches[bi] != lastBatches[bi]]
-        if sum(bytes) == 0 and len(offsets) == 0:
-          if len(updatedBatches) > 0:
-            if testTryCount >= maxConsecutiveNoBytesOutstandingMicrobatchRetries:
-              break
-            else:
-              testTryCount += 1
+  def _queries(self):
+    queries = self._dependentQuery._queries() if self._dependentQuery is not None else []
+    return queries + [self._streamingQuery]
+
+  def awaitAllProcessed(self, shutdownLatencySecs = 30, maxIdleChecks = 3):
+    # Woken up by progress, idle and termination events of any query in the chain. Upstream queries are checked
+    # first so a downstream query is only seen as done after everything upstream has committed its last version.
+    # shutdownLatencySecs bounds the wait between checks in case no event arrives. A query whose offset never reaches
+    # the source's latest version counts as done once it was idle for maxIdleChecks consecutive checks
+    queries = self._queries()
+    listener = ProgressListener([str(q.id) for q in queries])
+    spark.streams.addListener(listener)
+    try:
+      events = listener.events()
+      idleChecks = 0
+      while not all(ProgressListener.caughtUp(q) for q in queries):
+        if all(ProgressListener.caughtUp(q) or ProgressListener.idle(q) for q in queries):
+          idleChecks += 1
+          if idleChecks >= maxIdleChecks:
+            break
         else:
-          testTryCount = 0
-      self.awaitTermination(awaitTerminationTimeout)
-      lastBatches.update(batches)
-
-  def awaitAllProcessedAndStop(self, shutdownLatencySecs = 30):
-    self.awaitAllProcessed(shutdownLatencySecs)
+          idleChecks = 0
+        events = listener.waitForEvent(events, shutdownLatencySecs)
+    finally:
+      spark.streams.removeListener(listener)
+
+  def awaitAllProcessedAndStop(self, shutdownLatencySecs = 30, maxIdleChecks = 3):
+    self.awaitAllProcessed(shutdownLatencySecs, maxIdleChecks)
+    while self.flush():
+      self.awaitAllProcessed(shutdownLatencySecs, maxIdleChecks)
     self.stop()
+    if self._metricsSink is not None:
+      self._metricsSink.flush()
+
+  def metrics(self):
+    # per stage and per batch phase timings and row counts, most recent last
+    return self._metricsSink.records() if self._metricsSink is not None else []
 
 class DataStreamWriter:
   _streamingQuery = None
   _dependentQuery = None
   _upstreamJoinCond = None
+  _flushFuncs = None
+  _mergeTransactions = None
+  _stageGates = None
+  _query = None
+  _explainFunc = None
+  _queryName = None
+  _metricsSink = None
+  _trigger = None
 
   def __init__(self,
                streamingQuery):
     self._streamingQuery = streamingQuery
+    self._flushFuncs = []
+    self._mergeTransactions = []
+    self._stageGates = []
   
   def _chainStreamingQuery(self, dependentQuery, upstreamJoinCond):
     self._dependentQuery = dependentQuery
     self._upstreamJoinCond = upstreamJoinCond
     return self
 
+  def _addFlushFunc(self, func):
+    self._flushFuncs.append(func)
+    return self
+
+  def _addMergeTransaction(self, mergeTransaction):
+    self._mergeTransactions.append(mergeTransaction)
+    return self
+
+  def _addStageGate(self, stageGate):
+    self._stageGates.append(stageGate)
+    return self
+
+  def _setExplain(self, explainFunc):
+    self._explainFunc = explainFunc
+    return self
+
+  def _explainStages(self):
+    stages = self._dependentQuery._explainStages() if self._dependentQuery is not None else []
+    return stages + [self._explainFunc() if self._explainFunc is not None else ['foreachBatch query']]
+
+  def explain(self):
+    print(elzyme.utils.formatStages(self._explainStages()))
+
   def _depth(self, index):
     if self._dependentQuery is not None:
       return self._dependentQuery._depth(index + 1)
     return index
     
   def option(self, name, value):
+    if name == 'checkpointLocation':
+      for mt in self._mergeTransactions:
+        mt.setCheckpointLocation(value)
     self._streamingQuery = self._streamingQuery.option(name, value)
     return self
     
   def trigger(self, availableNow=None, processingTime=None, once=None, continuous=None):
     if self._dependentQuery is not None:
       self._dependentQuery.trigger(availableNow=availableNow, processingTime=processingTime, once=once, continuous=continuous)
-    self._streamingQuery = self._streamingQuery.trigger(availableNow=availableNow, processingTime=processingTime, once=once, continuous=continuous)
+    self._trigger = {'availableNow': availableNow, 'processingTime': processingTime, 'once': once, 'continuous': continuous}
+    self._streamingQuery = self._streamingQuery.trigger(**self._trigger)
     return self
   
   def queryName(self, name):
+    self._queryName = name
     self._streamingQuery = self._streamingQuery.queryName(name)
     return self
+
+  def metrics(self, path, metricsSink = None):
+    # one sink collects the batches of every stage of the chain and appends them to the Delta table at path
+    if metricsSink is None:
+      metricsSink = MetricsSink(path)
+    if self._dependentQuery is not None:
+      self._dependentQuery.metrics(path, metricsSink)
+    self._metricsSink = metricsSink
+    return self
+
+  def _startStage(self, scheduler, stage):
+    scheduler.startStage(stage, self._stageGates)
+    for gate in self._stageGates:
+      gate.setMetrics(self._metricsSink, self._queryName if self._queryName is not None else f'stage{stage}')
   
   @property
   def stream(self):
     return self._streamingQuery
 
-  def start(self):
+  def start(self, scheduler = None):
+    # Every query of the chain shares the scheduler, which assigns it a FAIR pool weighted by its stage
+    return self._start(scheduler if scheduler is not None else PipelineScheduler(), self._depth(0))
+
+  def isActive(self):
+    return self._query is not None and self._query.isActive
+
+  def _start(self, scheduler, stage):
+    if self.isActive():
+      return self._query._attach()
     dq = None
     if self._dependentQuery is not None:
-      dq = self._dependentQuery.start()
-    spark.sparkContext.setLocalProperty("spark.scheduler.pool", str(uuid.uuid4()))
+      dq = self._dependentQuery._start(scheduler, stage - 1)
+    self._startStage(scheduler, stage)
     sq = self.stream.start()
-    return StreamingQuery(sq, dq)
\ No newline at end of file
+    self._query = StreamingQuery(sq, dq, self._flushFuncs, self._metricsSink)
+    return self._query
+
+  def runAvailableNow(self, scheduler = None):
+    # Runs the chain stage by stage, each one drained with availableNow before its consumer starts, so consumers
+    # read the accumulated upstream changes in a few large batches instead of many near-empty ones
+    summary = []
+    self._runAvailableNow(scheduler if scheduler is not None else PipelineScheduler(), self._depth(0), summary)
+    if self._metricsSink is not None:
+      self._metricsSink.flush()
+    return summary
+
+  def _runAvailableNow(self, scheduler, stage, summary):
+    if self.isActive():
+      # kept up to date by the pipeline that started it, which must still have caught up before the consumer reads it
+      startedAt = time.time()
+      self._query.awaitAllProcessed()
+      while self._query.flush():
+        self._query.awaitAllProcessed()
+      summary.append({'stage': stage, 'name': self._query._streamingQuery.name, 'id': str(self._query._streamingQuery.id), 'attached': True, 'durationSecs': time.time() - startedAt})
+      return
+    if self._dependentQuery is not None:
+      self._dependentQuery._runAvailableNow(scheduler, stage - 1, summary)
+    self._startStage(scheduler, stage)
+    startedAt = time.time()
+    self.stream.trigger(availableNow=True)
+    try:
+      sq = self.stream.start()
+    finally:
+      # availableNow only applies to this run, a later start() keeps the trigger the writer was configured with
+      self.stream.trigger(**(self._trigger if self._trigger is not None else {'processingTime': '0 seconds'}))
+    sq.awaitTermination()
+    # coalesced writes still buffered must reach the target before the consumer reads it
+    while StreamingQuery(sq, None, self._flushFuncs).flush():
+      pass
+    progress = sq.recentProgress
+    summary.append({
+      'stage': stage,
+      'name': sq.name,
+      'id': str(sq.id),
+      'batches': len(progress),
+      'numInputRows': sum(p['numInputRows'] for p in progress),
+      'durationSecs': time.time() - startedAt
+    })
\ No newline at end of file
@@ -0,0 +1,91 @@
+from databricks.sdk.runtime import *
+import hashlib
+import json
+
+class MergeTransaction:
+  _targetId = None
+  _checkpointLocation = None
+  _appId = None
+  _lookback = None
+
+  def __init__(self,
+               tableName,
+               lookback = 20):
+    m = hashlib.sha256()
+    m.update(tableName.encode('ascii'))
+    self._targetId = m.hexdigest()
+    self._lookback = lookback
+
+  def setCheckpointLocation(self, checkpointLocation):
+    self._checkpointLocation = checkpointLocation
+    self._appId = None
+    return self
+
+  def lookback(self):
+    return self._lookback
+
+  def appId(self):
+    # The streaming query id is persisted in the checkpoint metadata, so it survives restarts
+    # but changes when the checkpoint is reset and batchIds start again from 0. Without a query id batchIds
+    # cannot be told apart from those of an earlier checkpoint, so there is no appId and no batch is ever skipped
+    if self._appId is None:
+      queryId = None
+      if self._checkpointLocation is not None:
+        try:
+          queryId = json.loads(dbutils.fs.head(f'{self._checkpointLocation}/metadata'))['id']
+        except Exception:
+          queryId = None
+      if queryId is None:
+        # foreachBatch runs on the query's own thread, which carries the query id as a local property
+        queryId = spark.sparkContext.getLocalProperty('sql.streaming.queryId')
+      if queryId is not None:
+        self._appId = f'{self._targetId}_{queryId}'
+    return self._appId
+
+  def _taggedCommits(self, deltaTable):
+    appId = self.appId()
+    commits = []
+    if appId is None:
+      return commits
+    # auto compaction may run in the same session and carry the same userMetadata, so only MERGE commits count
+    for r in deltaTable.history(self._lookback).where("operation = 'MERGE'").select('version', 'userMetadata').collect():
+      if r[1] is None:
+        continue
+      try:
+        tag = json.loads(r[1])
+      except ValueError:
+        continue
+      if isinstance(tag, dict) and tag.get('appId') == appId:
+        commits.append((r[0], tag.get('batchId')))
+    return commits
+
+  def isCommitted(self, deltaTable, batchId):
+    return any(b is not None and b >= batchId for v, b in self._taggedCommits(deltaTable))
+
+  def committedVersion(self, deltaTable, batchId):
+    versions = [v for v, b in self._taggedCommits(deltaTable) if b == batchId]
+    return max(versions) if len(versions) > 0 else None
+
+  def operationMetrics(self, deltaTable, batchId):
+    # the metrics of the MERGE tagged with this batch, not of whatever else committed to the table last
+    version = self.committedVersion(deltaTable, batchId)
+    if version is None:
+      return None
+    rows = deltaTable.history(self._lookback).where(f'version = {version}').select('operationMetrics').collect()
+    return rows[0][0] if len(rows) > 0 else None
+
+  def run(self, batchDf, batchId, func):
+    # txnAppId/txnVersion let Delta reject a replayed commit on its own, userMetadata lets us find it in the history
+    # The confs are set on the batch's session, so the DeltaTable committing the MERGE must be bound to that session too
+    if self.appId() is None:
+      return func()
+    conf = batchDf._jdf.sparkSession().conf()
+    conf.set('spark.databricks.delta.write.txnAppId', self.appId())
+    conf.set('spark.databricks.delta.write.txnVersion', str(batchId))
+    conf.set('spark.databricks.delta.commitInfo.userMetadata', json.dumps({'appId': self.appId(), 'batchId': batchId}))
+    try:
+      return func()
+    finally:
+      conf.unset('spark.databricks.delta.write.txnAppId')
+      conf.unset('spark.databricks.delta.write.txnVersion')
+      conf.unset('spark.databricks.delta.commitInfo.userMetadata')
\ No newline at end of file
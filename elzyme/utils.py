@@ -1,5 +1,10 @@
 import pyspark.sql.types
 from pyspark.sql.types import _parse_datatype_string
+from pyspark.sql import functions as F
+import datetime
+import decimal
+import hashlib
+import types
 
 def toDDL(self):
     """
@@ -11,4 +16,144 @@ def toDDL(self):
     json = self.json()
     return dt.fromJson(json).toDDL()
 pyspark.sql.types.DataType.toDDL = toDDL
-pyspark.sql.types.StructType.fromDDL = _parse_datatype_string
\ No newline at end of file
+pyspark.sql.types.StructType.fromDDL = _parse_datatype_string
+
+_epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+def sqlLiteral(value):
+  if value is None:
+    return 'null'
+  if isinstance(value, str):
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  if isinstance(value, datetime.datetime):
+    # collected timestamps are naive in the driver's timezone, which need not be the session timezone a TIMESTAMP'...'
+    # literal is read in, so they are rendered as the exact epoch they stand for instead
+    micros = (value.astimezone(datetime.timezone.utc) - _epoch) // datetime.timedelta(microseconds=1)
+    return f'timestamp_seconds({decimal.Decimal(micros).scaleb(-6)})'
+  if isinstance(value, datetime.date):
+    return f"DATE'{value.isoformat()}'"
+  return str(value)
+
+def _isSuccessor(a, b):
+  if isinstance(a, bool) or isinstance(b, bool):
+    return False
+  if isinstance(a, int) and isinstance(b, int):
+    return b == a + 1
+  if isinstance(a, datetime.datetime) or isinstance(b, datetime.datetime):
+    return False
+  if isinstance(a, datetime.date) and isinstance(b, datetime.date):
+    return b - a == datetime.timedelta(days=1)
+  return False
+
+def _contiguousRuns(values):
+  runs = []
+  for v in values:
+    if len(runs) > 0 and _isSuccessor(runs[-1][-1], v):
+      runs[-1].append(v)
+    else:
+      runs.append([v])
+  return runs
+
+def _cellContents(cell):
+  try:
+    return cell.cell_contents
+  except ValueError:
+    return None
+
+def _canonicalCode(code, globals, seen):
+  # the global names a function reads are resolved to their current values, nested code reads the same globals
+  consts = [(_canonicalCode(c, globals, seen) if isinstance(c, types.CodeType) else _canonical(c, seen)) for c in code.co_consts]
+  names = [(f'{n}={_canonical(globals[n], seen)}' if n in globals else n) for n in code.co_names]
+  return f'code({code.co_code.hex()},{",".join(consts)},{",".join(names)})'
+
+def _canonical(value, seen):
+  if value is None or isinstance(value, (str, bool, int, float, datetime.date)):
+    return repr(value)
+  if isinstance(value, (list, tuple)):
+    return '[' + ','.join([_canonical(v, seen) for v in value]) + ']'
+  if isinstance(value, (set, frozenset)):
+    return '{' + ','.join(sorted([_canonical(v, seen) for v in value])) + '}'
+  if isinstance(value, dict):
+    return '{' + ','.join(sorted([f'{_canonical(k, seen)}:{_canonical(v, seen)}' for k, v in value.items()])) + '}'
+  if isinstance(value, pyspark.sql.Column):
+    return str(value)
+  if isinstance(value, pyspark.sql.types.DataType):
+    return value.json()
+  if isinstance(value, types.ModuleType):
+    return f'module({value.__name__})'
+  if isinstance(value, (type, types.BuiltinFunctionType)):
+    return f'{value.__module__}.{value.__qualname__}'
+  if id(value) in seen:
+    return '<cycle>'
+  seen = seen | {id(value)}
+  if hasattr(value, 'fingerprint'):
+    return value.fingerprint()
+  if isinstance(value, types.CodeType):
+    return _canonicalCode(value, {}, seen)
+  if isinstance(value, types.FunctionType):
+    # functions are identified by their code, defaults, captured variables and the globals they read rather than by identity
+    closure = [_cellContents(c) for c in (value.__closure__ or [])]
+    return f'func({_canonicalCode(value.__code__, value.__globals__, seen)},{_canonical(value.__defaults__, seen)},{_canonical(closure, seen)})'
+  if isinstance(value, types.MethodType):
+    return f'method({_canonical(value.__func__, seen)},{_canonical(value.__self__, seen)})'
+  if type(value).__module__.startswith('elzyme') and hasattr(value, '__dict__'):
+    # upstream queries are identified through the source of the stream reading their output
+    attrs = {k: v for k, v in vars(value).items() if k not in ['_dependentQuery', '_upstreamJoinCond']}
+    return f'{type(value).__qualname__}({_canonical(attrs, seen)})'
+  # anything else cannot be compared by value, so it only ever matches itself
+  return f'<{type(value).__qualname__}@{id(value)}>'
+
+def fingerprint(*values):
+  """
+  Returns a sha256 over a canonical form of values, including the code and captured variables of functions,
+  so that two pipelines built from identical definitions get the same fingerprint.
+  """
+  return hashlib.sha256(_canonical(values, frozenset()).encode('utf-8')).hexdigest()
+
+def partitionPruneCondition(batchDf, prunedPartitionColumns, hasNullableKeys, alias = 'u'):
+  # The ranges and approximate distinct counts of all pruned columns are computed in a single aggregate job.
+  # Distinct values are only collected, in a second job, for the columns whose count is within the cap,
+  # so a high cardinality column never builds its full set on the executors and falls back to a min/max range
+  aggCols = []
+  for i, pc in enumerate(prunedPartitionColumns):
+    c = F.col(pc.column())
+    aggCols += [F.approx_count_distinct(c).alias(f'__distinct_{i}'),
+                F.min(c).alias(f'__min_{i}'),
+                F.max(c).alias(f'__max_{i}'),
+                F.max(c.isNull().cast('int')).alias(f'__nulls_{i}')]
+  row = batchDf.agg(*aggCols).collect()[0]
+  valueCols = [F.slice(F.array_sort(F.collect_set(pc.column())), 1, pc.maxValues() + 1).alias(f'__values_{i}')
+               for i, pc in enumerate(prunedPartitionColumns) if row[f'__distinct_{i}'] <= pc.maxValues()]
+  valuesRow = batchDf.agg(*valueCols).collect()[0].asDict() if len(valueCols) > 0 else {}
+  conds = []
+  for i, pc in enumerate(prunedPartitionColumns):
+    col = f'{alias}.{pc.column()}'
+    # approx_count_distinct may undercount, so a collected set can still exceed the cap
+    values = valuesRow.get(f'__values_{i}')
+    preds = []
+    if values is None or len(values) > pc.maxValues():
+      preds += [f'{col} BETWEEN {sqlLiteral(row[f"__min_{i}"])} AND {sqlLiteral(row[f"__max_{i}"])}']
+    else:
+      singles = []
+      for run in _contiguousRuns(values):
+        if len(run) > 2:
+          preds += [f'{col} BETWEEN {sqlLiteral(run[0])} AND {sqlLiteral(run[-1])}']
+        else:
+          singles += run
+      if len(singles) > 0:
+        preds = [f"{col} in ({','.join([sqlLiteral(v) for v in singles])})"] + preds
+    if row[f'__nulls_{i}'] == 1 or (hasNullableKeys and len(preds) > 0):
+      preds += [f'{col} is null']
+    if len(preds) > 0:
+      conds += [f"({' OR '.join(preds)})"]
+  return ' AND '.join(conds)
+
+def formatStages(stages):
+  # every stage is a list of lines, the first one naming the stage
+  lines = []
+  for i, stage in enumerate(stages):
+    lines.append(f'Stage {i}: {stage[0]}')
+    lines += [f'  {l}' for l in stage[1:]]
+  return '\n'.join(lines)
@@ -0,0 +1,33 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+j = (
+  t.cube("customer_id", "operation")
+   .agg(F.sum("amount").alias("amount"), F.count("amount").alias("count"))
+   .writeToPath(f'{gold_path}/aggs')
+   .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+   .queryName(f'{gold_path}/aggs')
+   .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+jj = tt.cube("customer_id", "operation").agg(F.sum("amount").alias("amount"), F.count("amount").alias("count"), F.grouping_id().alias("grouping_id"))
+jj.count()
+
+# COMMAND ----------
+
+df = spark.read.format('delta').load(f'{gold_path}/aggs')
+df.count()
+
+# COMMAND ----------
+
+compare_dataframes(df, jj)
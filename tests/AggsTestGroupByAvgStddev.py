@@ -0,0 +1,34 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+j = (
+  t.groupBy("customer_id")
+   .agg(F.avg("amount").alias("avg"), F.stddev("amount").alias("stddev"), F.var_pop("amount").alias("var_pop"), F.count("amount").alias("count"))
+   .writeToPath(f'{gold_path}/aggs')
+   .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+   .queryName(f'{gold_path}/aggs')
+   .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+jj = tt.groupBy("customer_id").agg(F.round(F.avg("amount"), 6).alias("avg"), F.round(F.stddev("amount"), 6).alias("stddev"), F.round(F.var_pop("amount"), 6).alias("var_pop"), F.count("amount").alias("count"))
+jj.count()
+
+# COMMAND ----------
+
+df = spark.read.format('delta').load(f'{gold_path}/aggs')
+df = df.select("customer_id", F.round("avg", 6).alias("avg"), F.round("stddev", 6).alias("stddev"), F.round("var_pop", 6).alias("var_pop"), "count")
+df.count()
+
+# COMMAND ----------
+
+compare_dataframes(df, jj)
@@ -0,0 +1,33 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+j = (
+  t.groupBy("customer_id")
+   .agg(sketchCountDistinct("transaction_id").alias("transactions"), F.count("amount").alias("count"))
+   .writeToPath(f'{gold_path}/aggs')
+   .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+   .queryName(f'{gold_path}/aggs')
+   .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+jj = tt.groupBy("customer_id").agg(F.expr("hll_sketch_estimate(hll_sketch_agg(transaction_id, 12))").alias("transactions"), F.count("amount").alias("count"))
+jj.count()
+
+# COMMAND ----------
+
+df = spark.read.format('delta').load(f'{gold_path}/aggs').drop('__hll_transactions')
+df.count()
+
+# COMMAND ----------
+
+compare_dataframes(df, jj)
@@ -0,0 +1,46 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+# transactions are joined with a null firstname until their customer arrives and then move to the customer's group,
+# which retracts every row of the null group
+j = (
+  t.join(c, 'left')
+   .onKeys('customer_id')
+   .groupBy("firstname", preAggregate = False)
+   .agg(F.sum("amount").alias("amount"), F.count("amount").alias("count"))
+   .deleteEmptyGroups()
+   .writeToPath(f'{gold_path}/aggs')
+   .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+   .queryName(f'{gold_path}/aggs')
+   .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+cc = spark.read.format('delta').load(f'{silver_path}/customers').withColumnRenamed('id', 'customer_id').withColumnRenamed('operation', 'customer_operation').withColumnRenamed('operation_date', 'customer_operation_date')
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+tt_cc = tt.join(cc, tt['customer_id'] == cc['customer_id'], 'left').drop(cc['customer_id'])
+jj = tt_cc.groupBy("firstname").agg(F.sum("amount").alias("amount"), F.count("amount").alias("count"))
+jj.count()
+
+# COMMAND ----------
+
+history = spark.sql(f"DESCRIBE HISTORY delta.`{gold_path}/aggs`").where("operation = 'MERGE'").select(F.sum(F.col('operationMetrics.numTargetRowsDeleted').cast('long'))).collect()[0][0]
+assert history is not None and history > 0, "the null group must have been deleted once all of its rows moved to their customers"
+
+# COMMAND ----------
+
+df = spark.read.format('delta').load(f'{gold_path}/aggs')
+assert df.where('__rows <= 0').count() == 0, "groups without contributing rows must be deleted"
+df.count()
+
+# COMMAND ----------
+
+compare_dataframes(df, jj)
@@ -0,0 +1,38 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+j = (
+  t.groupBy("customer_id", "operation")
+   .agg(F.sum("amount").alias("total_amount"), F.count("amount").alias("count"))
+   .groupBy("customer_id", fuse = True)
+   .agg(F.sum("total_amount").alias("total_amount"), F.sum("count").alias("count"))
+   .writeToPath(f'{gold_path}/aggs')
+   .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+   .queryName(f'{gold_path}/aggs')
+   .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+jj = (
+  tt.groupBy("customer_id", "operation").agg(F.sum("amount").alias("total_amount"), F.count("amount").alias("count"))
+    .groupBy("customer_id").agg(F.sum("total_amount").alias("total_amount"), F.sum("count").alias("count"))
+)
+jj.count()
+
+# COMMAND ----------
+
+df = spark.read.format('delta').load(f'{gold_path}/aggs')
+df.count()
+
+# COMMAND ----------
+
+compare_dataframes(df, jj)
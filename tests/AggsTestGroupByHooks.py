@@ -0,0 +1,48 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+import elzyme.metrics
+
+class PhaseRecorder:
+  def __init__(self):
+    self.phases = []
+
+  def onPhaseStart(self, phase):
+    pass
+
+  def onPhaseEnd(self, phase):
+    self.phases.append((phase.stage, phase.batchId, phase.name, sorted(phase.dataFrames.keys())))
+
+recorder = elzyme.metrics.addHook(PhaseRecorder())
+
+# COMMAND ----------
+
+j = (
+  t.groupBy("customer_id")
+   .agg(F.sum("amount").alias("amount"), F.count("amount").alias("count"))
+   .writeToPath(f'{gold_path}/aggs')
+   .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+   .queryName(f'{gold_path}/aggs')
+   .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+elzyme.metrics.removeHook(recorder)
+
+# COMMAND ----------
+
+names = set([p[2] for p in recorder.phases])
+assert {'merge', 'aggregateDeltas', 'mergeExecute'} <= names
+assert all(p[0] == f'{gold_path}/aggs' and p[1] is not None for p in recorder.phases)
+assert all('deltas' in p[3] for p in recorder.phases if p[2] == 'aggregateDeltas')
+
+# COMMAND ----------
+
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+jj = tt.groupBy("customer_id").agg(F.sum("amount").alias("amount"), F.count("amount").alias("count"))
+compare_dataframes(spark.read.format('delta').load(f'{gold_path}/aggs'), jj)
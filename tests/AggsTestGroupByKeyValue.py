@@ -0,0 +1,45 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+import os
+import json
+import sqlite3
+
+kv_path = f"/local_disk0/tmp/demo/{notebook_name}/aggs.db"
+os.makedirs(os.path.dirname(kv_path), exist_ok=True)
+if os.path.exists(kv_path):
+  os.remove(kv_path)
+
+# COMMAND ----------
+
+j = (
+  t.groupBy("customer_id")
+   .agg(F.sum("amount").alias("amount"), F.count("amount").alias("count"))
+   .writeToKeyValue(kv_path, path = f'{gold_path}/aggs')
+   .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+   .queryName(f'{gold_path}/aggs')
+   .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+df = spark.read.format('delta').load(f'{gold_path}/aggs')
+df.count()
+
+# COMMAND ----------
+
+with sqlite3.connect(kv_path) as conn:
+  kvRows = [json.loads(v) for (v,) in conn.execute('SELECT value FROM kv').fetchall()]
+kvDf = spark.createDataFrame(kvRows, schema = df.schema)
+kvDf.count()
+
+# COMMAND ----------
+
+compare_dataframes(kvDf, df)
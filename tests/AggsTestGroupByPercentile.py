@@ -0,0 +1,34 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+j = (
+  t.groupBy("customer_id")
+   .agg(sketchPercentile("amount", [0.5, 0.95, 0.99]).alias("amount_percentiles"), F.count("amount").alias("count"))
+   .writeToPath(f'{gold_path}/aggs')
+   .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+   .queryName(f'{gold_path}/aggs')
+   .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+sp = sketchPercentile("amount", [0.5, 0.95, 0.99]).alias("amount_percentiles")
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+jj = tt.groupBy("customer_id").agg(sp.toColumn(), F.count("amount").alias("count")).select("customer_id", F.expr(sp.estimateSql(sp.sketchName())).alias("amount_percentiles"), "count")
+jj.count()
+
+# COMMAND ----------
+
+df = spark.read.format('delta').load(f'{gold_path}/aggs').drop(sp.sketchName())
+df.count()
+
+# COMMAND ----------
+
+compare_dataframes(df, jj)
@@ -0,0 +1,39 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+# the joined target carries the map-typed percentile sketch, which the merge must compare to skip unchanged rows
+j = (
+  t.groupBy("customer_id")
+   .agg(sketchPercentile("amount", [0.5, 0.95, 0.99]).alias("amount_percentiles"), F.count("amount").alias("count"))
+   .join(c, 'left')
+   .onKeys("customer_id")
+   .writeToPath(f'{gold_path}/aggs')
+   .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+   .queryName(f'{gold_path}/aggs')
+   .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+sp = sketchPercentile("amount", [0.5, 0.95, 0.99]).alias("amount_percentiles")
+cc = spark.read.format('delta').load(f'{silver_path}/customers').withColumnRenamed('id', 'customer_id').withColumnRenamed('operation', 'customer_operation').withColumnRenamed('operation_date', 'customer_operation_date')
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+tt_g = tt.groupBy("customer_id").agg(sp.toColumn(), F.count("amount").alias("count")).select("customer_id", F.expr(sp.estimateSql(sp.sketchName())).alias("amount_percentiles"), "count")
+jj = tt_g.join(cc, tt_g['customer_id'] == cc['customer_id'], 'left').drop(cc['customer_id'])
+jj.count()
+
+# COMMAND ----------
+
+df = spark.read.format('delta').load(f'{gold_path}/aggs').drop(sp.sketchName())
+df.count()
+
+# COMMAND ----------
+
+compare_dataframes(df, jj)
@@ -0,0 +1,44 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+def startAggs():
+  return (
+    t.groupBy("customer_id")
+     .agg(F.sum("amount").alias("total_amount"), F.count("amount").alias("count"))
+     .writeToPath(f'{gold_path}/aggs')
+     .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+     .queryName(f'{gold_path}/aggs')
+     .start()
+  )
+
+j = startAggs()
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+# forget the last batch's commit so the restarted query replays it with the same batchId
+versionBefore = DeltaTable.forPath(spark, f'{gold_path}/aggs').history(1).select('version').collect()[0][0]
+commits = sorted([f for f in dbutils.fs.ls(f'{checkpointLocation}/gold/aggs/commits') if f.name.isdigit()], key = lambda f: int(f.name))
+assert len(commits) > 0, "the query must have committed batches"
+dbutils.fs.rm(commits[-1].path)
+
+j = startAggs()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+versionAfter = DeltaTable.forPath(spark, f'{gold_path}/aggs').history(1).select('version').collect()[0][0]
+assert versionAfter == versionBefore, f"the replayed batch must be skipped, the target moved from version {versionBefore} to {versionAfter}"
+
+# COMMAND ----------
+
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+jj = tt.groupBy("customer_id").agg(F.sum("amount").alias("total_amount"), F.count("amount").alias("count"))
+df = spark.read.format('delta').load(f'{gold_path}/aggs')
+compare_dataframes(df, jj)
@@ -0,0 +1,35 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+# values far from zero make a sum of squares cancel out, the deviations must still survive retractions
+j = (
+  t.groupBy("customer_id")
+   .agg(F.stddev(F.col("amount") + 1e9).alias("stddev"), F.var_pop(F.col("amount") + 1e9).alias("var_pop"), F.count("amount").alias("count"))
+   .writeToPath(f'{gold_path}/aggs')
+   .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+   .queryName(f'{gold_path}/aggs')
+   .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+jj = tt.groupBy("customer_id").agg(F.round(F.stddev(F.col("amount") + 1e9), 4).alias("stddev"), F.round(F.var_pop(F.col("amount") + 1e9), 4).alias("var_pop"), F.count("amount").alias("count"))
+jj.count()
+
+# COMMAND ----------
+
+df = spark.read.format('delta').load(f'{gold_path}/aggs')
+df = df.select("customer_id", F.round("stddev", 4).alias("stddev"), F.round("var_pop", 4).alias("var_pop"), "count")
+df.count()
+
+# COMMAND ----------
+
+compare_dataframes(df, jj)
@@ -0,0 +1,39 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+from pyspark.sql.window import Window
+
+j = (
+  t.groupBy("customer_id")
+   .topN(3, orderBy = F.col("amount").cast("double"), reserve = 2)
+   .writeToPath(f'{gold_path}/topn')
+   .option("checkpointLocation", f'{checkpointLocation}/gold/topn')
+   .queryName(f'{gold_path}/topn')
+   .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+jj = (
+  tt.withColumn("__rank", F.row_number().over(Window.partitionBy("customer_id").orderBy(F.col("amount").cast("double").desc())))
+    .where("__rank <= 3")
+    .select("customer_id", F.col("__rank").alias("rank"), F.col("amount").cast("double").alias("amount"))
+)
+jj.count()
+
+# COMMAND ----------
+
+df = spark.read.format('delta').load(f'{gold_path}/topn').select("customer_id", F.col("__rank").alias("rank"), F.col("amount").cast("double").alias("amount"))
+df.count()
+
+# COMMAND ----------
+
+compare_dataframes(df, jj)
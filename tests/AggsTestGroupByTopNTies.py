@@ -0,0 +1,44 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+from pyspark.sql.window import Window
+
+# item counts tie within most customers, each tied row must still take a rank of its own, and the map column
+# must survive being ordered and grouped inside the topN state
+tm = t.to(lambda df: df.withColumn("tags", F.create_map(F.lit("operation"), F.col("operation"))))
+j = (
+  tm.groupBy("customer_id")
+    .topN(3, orderBy = F.col("item_count").cast("int"), reserve = 2)
+    .writeToPath(f'{gold_path}/topn')
+    .option("checkpointLocation", f'{checkpointLocation}/gold/topn')
+    .queryName(f'{gold_path}/topn')
+    .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+jj = (
+  tt.withColumn("__rank", F.row_number().over(Window.partitionBy("customer_id").orderBy(F.col("item_count").cast("int").desc())))
+    .where("__rank <= 3")
+    .select("customer_id", F.col("__rank").alias("rank"), F.col("item_count").cast("int").alias("item_count"))
+)
+jj.count()
+
+# COMMAND ----------
+
+df = spark.read.format('delta').load(f'{gold_path}/topn')
+assert df.where(F.col("tags")["operation"].eqNullSafe(F.col("operation")) == False).count() == 0, "the map column must be written back as it was read"
+df = df.select("customer_id", F.col("__rank").alias("rank"), F.col("item_count").cast("int").alias("item_count"))
+df.count()
+
+# COMMAND ----------
+
+compare_dataframes(df, jj)
@@ -0,0 +1,46 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+# window starts are pruned with literals collected on the driver, which must select the same instants in any session timezone
+spark.conf.set('spark.sql.session.timeZone', 'America/Los_Angeles')
+
+# COMMAND ----------
+
+j = (
+  t.groupBy(window(F.to_timestamp('operation_date', 'MM-dd-yyyy HH:mm:ss'), '1 day', '6 hours'), "customer_id")
+   .agg(F.sum("amount").alias("amount"), F.count("amount").alias("count"))
+   .writeToPath(f'{gold_path}/aggs')
+   .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+   .queryName(f'{gold_path}/aggs')
+   .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+jj = (
+  tt.groupBy(F.window(F.to_timestamp('operation_date', 'MM-dd-yyyy HH:mm:ss'), '1 day', '6 hours'), "customer_id")
+    .agg(F.sum("amount").alias("amount"), F.count("amount").alias("count"))
+    .select(F.col("window.start").alias("window_start"), F.col("window.end").alias("window_end"), "customer_id", "amount", "count")
+)
+jj.count()
+
+# COMMAND ----------
+
+df = spark.read.format('delta').load(f'{gold_path}/aggs')
+df.count()
+
+# COMMAND ----------
+
+compare_dataframes(df, jj)
+
+# COMMAND ----------
+
+spark.conf.unset('spark.sql.session.timeZone')
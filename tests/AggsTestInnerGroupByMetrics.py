@@ -0,0 +1,40 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+j = (
+  c.join(t)
+  .onKeys('customer_id')
+  .groupBy("customer_id")
+  .agg(F.sum("amount").alias("total_amount"), F.count("amount").alias("count"))
+  .writeToPath(f'{gold_path}/aggs')
+  .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+  .queryName(f'{gold_path}/aggs')
+  .metrics(f'{gold_path}/metrics')
+  .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+# both the staging join and the aggregation report their batches, in memory and in the metrics table
+records = j.metrics()
+assert len(set([r['stage'] for r in records])) == 2
+assert all('merge' in r['phases'] for r in records if len(r['phases']) > 0)
+assert sum([r['counts'].get('leftRows', 0) + r['counts'].get('rightRows', 0) for r in records]) > 0
+assert spark.read.format('delta').load(f'{gold_path}/metrics').count() == len(records)
+
+# COMMAND ----------
+
+cc = spark.read.format('delta').load(f'{silver_path}/customers').withColumnRenamed('id', 'customer_id').withColumnRenamed('operation', 'customer_operation').withColumnRenamed('operation_date', 'customer_operation_date')
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id').withColumn('date', F.year(F.to_date('operation_date', 'MM-dd-yyyy HH:mm:ss')) * 10000 + F.month(F.to_date('operation_date', 'MM-dd-yyyy HH:mm:ss')) * 100)
+jj = cc.join(tt, tt['customer_id'] == cc['customer_id']).drop(cc['customer_id']).groupBy("customer_id").agg(F.sum("amount").alias("total_amount"), F.count("amount").alias("count"))
+
+# COMMAND ----------
+
+compare_dataframes(spark.read.format('delta').load(f'{gold_path}/aggs'), jj)
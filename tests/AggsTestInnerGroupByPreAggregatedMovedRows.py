@@ -0,0 +1,40 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+# transactions move between operation groups as they are updated, groups left without transactions must disappear
+j = (
+  t.join(c)
+  .onKeys('customer_id')
+  .groupBy("customer_id", "operation", preAggregate = True)
+  .agg(F.sum("amount").alias("total_amount"), F.count("amount").alias("count"))
+  .writeToPath(f'{gold_path}/aggs')
+  .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+  .queryName(f'{gold_path}/aggs')
+  .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+cc = spark.read.format('delta').load(f'{silver_path}/customers').withColumnRenamed('id', 'customer_id').withColumnRenamed('operation', 'customer_operation').withColumnRenamed('operation_date', 'customer_operation_date')
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+tt_cc = tt.join(cc, tt['customer_id'] == cc['customer_id']).drop(cc['customer_id'])
+jj = tt_cc.groupBy("customer_id", "operation").agg(F.sum("amount").alias("total_amount"), F.count("amount").alias("count"))
+jj.count()
+
+# COMMAND ----------
+
+df = spark.read.format('delta').load(f'{gold_path}/aggs')
+assert '__rows' not in df.columns, "the hidden row count must not be written to the joined target"
+assert df.where('count = 0').count() == 0, "groups without contributing rows must be deleted"
+df.count()
+
+# COMMAND ----------
+
+compare_dataframes(df, jj)
@@ -0,0 +1,51 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+activeBefore = len(spark.streams.active)
+j1 = (
+  t.join(c, 'left')
+  .onKeys('customer_id')
+  .groupBy("customer_id", preAggregate = False)
+  .agg(F.sum("amount").alias("total_amount"))
+  .writeToPath(f'{gold_path}/aggs_sum')
+  .option("checkpointLocation", f'{checkpointLocation}/gold/aggs_sum')
+  .queryName(f'{gold_path}/aggs_sum')
+  .start()
+)
+j2 = (
+  t.join(c, 'left')
+  .onKeys('customer_id')
+  .groupBy("customer_id", preAggregate = False)
+  .agg(F.count("amount").alias("count"))
+  .writeToPath(f'{gold_path}/aggs_count')
+  .option("checkpointLocation", f'{checkpointLocation}/gold/aggs_count')
+  .queryName(f'{gold_path}/aggs_count')
+  .start()
+)
+
+# COMMAND ----------
+
+# the join is staged rather than pre-aggregated, the second pipeline attaches to the staging join of the first one instead of starting its own
+assert len(spark.streams.active) == activeBefore + 3
+
+# COMMAND ----------
+
+awaitInputTermination()
+j1.awaitAllProcessed()
+j2.awaitAllProcessedAndStop()
+j1.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+cc = spark.read.format('delta').load(f'{silver_path}/customers').withColumnRenamed('id', 'customer_id').withColumnRenamed('operation', 'customer_operation').withColumnRenamed('operation_date', 'customer_operation_date')
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id').withColumn('date', F.year(F.to_date('operation_date', 'MM-dd-yyyy HH:mm:ss')) * 10000 + F.month(F.to_date('operation_date', 'MM-dd-yyyy HH:mm:ss')) * 100)
+tt_cc = tt.join(cc, tt['customer_id'] == cc['customer_id'], 'left').drop(cc['customer_id'])
+jj1 = tt_cc.groupBy("customer_id").agg(F.sum("amount").alias("total_amount"))
+jj2 = tt_cc.groupBy("customer_id").agg(F.count("amount").alias("count"))
+
+# COMMAND ----------
+
+compare_dataframes(spark.read.format('delta').load(f'{gold_path}/aggs_sum'), jj1)
+compare_dataframes(spark.read.format('delta').load(f'{gold_path}/aggs_count'), jj2)
@@ -0,0 +1,37 @@
+# Databricks notebook source
+# MAGIC %run "./SetupInputStream"
+
+# COMMAND ----------
+
+j = (
+  t.join(c)
+  .onKeys('customer_id')
+  .groupBy("customer_id", preAggregate = True)
+  .agg(F.sum("amount").alias("total_amount"), F.count("amount").alias("count"))
+  .writeToPath(f'{gold_path}/aggs')
+  .option("checkpointLocation", f'{checkpointLocation}/gold/aggs')
+  .queryName(f'{gold_path}/aggs')
+  .start()
+)
+
+# COMMAND ----------
+
+awaitInputTermination()
+j.awaitAllProcessedAndStop()
+
+# COMMAND ----------
+
+cc = spark.read.format('delta').load(f'{silver_path}/customers').withColumnRenamed('id', 'customer_id').withColumnRenamed('operation', 'customer_operation').withColumnRenamed('operation_date', 'customer_operation_date')
+tt = spark.read.format('delta').load(f'{silver_path}/transactions').withColumnRenamed('id', 'transaction_id')
+tt_cc = tt.join(cc, tt['customer_id'] == cc['customer_id']).drop(cc['customer_id'])
+jj = tt_cc.groupBy("customer_id").agg(F.sum("amount").alias("total_amount"), F.count("amount").alias("count"))
+jj.count()
+
+# COMMAND ----------
+
+df = spark.read.format('delta').load(f'{gold_path}/aggs')
+df.count()
+
+# COMMAND ----------
+
+compare_dataframes(df, jj)